@@ -1,35 +1,41 @@
 import base64
 from datetime import datetime
 from uuid import UUID
-from fastapi import APIRouter, Depends, HTTPException, Response
-from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 from app.site_router.site_views import site_router
 from app.database.engine import create_db
 from app.tg_bot_router.bot import start_bot, stop_bot, bot_router
 from app.payment_router.payment_views import payment_router
 from app.skynet_api_router.skynet_api_views import api_router
-from app.database.engine import get_async_session
+from app.database.engine import async_session_maker
 from app.tg_bot_router.bot import bot
-from app.setup_logger import logger
-from app.database.queries import (
-    orm_get_servers,
-    orm_get_user_by_tgid,
-    orm_get_user_servers,
-)
-from app.utils.three_x_ui_api import ThreeXUIServer
+from app.database.queries import orm_get_user_with_servers
+from app.utils.three_x_ui_api import get_panels
+from app.utils.metrics import metrics
+from app.utils.outbox import outbox
+from app.utils.panel_registry import panel_registry
+from app.utils.subscription import collect_configs, known_traffics, subscription_flights, subscription_response
+from app.utils.traffic_poller import TRAFFIC_POLL_INTERVAL, poll_traffic
+from app.utils.subscription_cache import RenderedSubscription, subscription_cache
 from app.payment_router.payment_views import recurent_payment, check_subscription_expiry,notify_expired_users
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_db()
+    async with async_session_maker() as session:
+        panels = await get_panels(session)
+    await panel_registry.open([panel.url for panel in panels])
     await start_bot()
+    await outbox.start()
 
     expired_trigger = CronTrigger(
         year="*", month="*", day="*", hour="21", minute="09", second="0"
@@ -66,9 +72,20 @@ async def lifespan(app: FastAPI):
         args=[bot]
     )
 
+    # Трафик need_gb серверов в traffic_snapshots - сразу и каждые TRAFFIC_POLL_INTERVAL секунд
+    scheduler.add_job(
+        poll_traffic,
+        trigger=IntervalTrigger(seconds=TRAFFIC_POLL_INTERVAL),
+        id='poll_traffic',
+        replace_existing=True,
+        next_run_time=datetime.now()
+    )
+
     scheduler.start()
     yield
+    await outbox.stop()
     await stop_bot()
+    await panel_registry.close()
 
 
 scheduler = AsyncIOScheduler()
@@ -80,62 +97,59 @@ app.include_router(api_router, tags=['Rest API'])
 
 
 
-@app.get("/subscription")
-async def generate_subscription_config(user_token: str, session: AsyncSession = Depends(get_async_session)):
-    user = await orm_get_user_by_tgid(session, int(user_token))
-    user_servers = await orm_get_user_servers(session, user.id)
-    if not user or not user_servers:
-        raise HTTPException(status_code=404, detail="User not found or no servers available")
-
-    # 3. Генерируем vless:// ссылки для каждого сервера
-    config_lines = []
-    
-    servers = await orm_get_servers(session)
-    threex_panels = []
-    for server in servers:
-        threex_panels.append(ThreeXUIServer(
-            server.id,
-            server.url,
-            server.indoub_id,
-            server.login,
-            server.password,
-            server.need_gb
-        ))
-    for user_server in user_servers:
-        vless_url = None
-        for panel in threex_panels:
-            if panel.id == user_server.server_id:
-                vless_url = await panel.get_client_vless(user_server.tun_id)
-                if panel.need_gb == True:
-                    trafic = await panel.client_remain_trafic(user_server.tun_id) or 0
-
-
-        
-        if not vless_url:
-            logger.warning(f"Пользователь не найден на сервере {user_server.server_id}")
-            continue
-        config_lines.append(vless_url)
-    
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики процесса в формате Prometheus: задержки и ошибки панелей по операциям."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def _build_subscription(key: tuple[str, str], user_token: str) -> RenderedSubscription:
+    """Сборка /subscription в своей сессии: её результат могут ждать несколько запросов."""
+    async with async_session_maker() as session:
+        user, user_servers = await orm_get_user_with_servers(session, telegram_id=int(user_token))
+        if not user or not user_servers:
+            raise HTTPException(status_code=404, detail="User not found or no servers available")
+        version = subscription_cache.version(user.id)
+
+        # 3. Генерируем vless:// ссылки для каждого сервера
+        threex_panels = {panel.id: panel for panel in await get_panels(session)}
+    pairs = [
+        (threex_panels[server_id], user_server.tun_id)
+        for server_id, user_server in user_servers.items()
+        if server_id in threex_panels
+    ]
+
+    config_lines, trafic, complete = await collect_configs(pairs, traffics=known_traffics(user_servers.values()))
+
     if not config_lines:
         raise HTTPException(status_code=404, detail="Не найдены сервера")
     subscription_content = "\n".join(config_lines)
 
-    response = Response(
-        content=subscription_content,
-        media_type="text/plain; charset=utf-8"
-    )
+    headers = {}
+    headers['profile-title'] = "base64:"+base64.b64encode('⚡️ SkynetVPN'.encode('utf-8')).decode('latin-1')
+    headers["announce"] = "base64:"+base64.b64encode(f"🚀 Нажмите сюда, чтобы перейти в нашего бота\n\n👑 - без рекламы на YouTube\n🎧 - YouTube можно сворачивать \n\nОтображаемое количество трафика относиться только к обходу белых списков.".encode('utf-8')).decode('latin-1')
+    headers["announce-url"] = "https://t.me/skynetaivpn_bot"
+    headers["subscription-userinfo"] = f"expire={int(user.sub_end.timestamp())}; upload={trafic[0]}; download={trafic[1]}; total={trafic[2]}"
+    headers["X-Frame-Options"] = 'SAMEORIGIN'
+    headers["Referrer-Policy"] = 'no-referrer-when-downgrade'
+    headers["X-Content-Type-Options"] = 'nosniff'
+    headers["Permissions-Policy"] = 'geolocation=(), microphone=()'
+    headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
 
-    response.headers['profile-title'] = "base64:"+base64.b64encode('⚡️ SkynetVPN'.encode('utf-8')).decode('latin-1')
-    response.headers["announce"] = "base64:"+base64.b64encode(f"🚀 Нажмите сюда, чтобы перейти в нашего бота\n\n👑 - без рекламы на YouTube\n🎧 - YouTube можно сворачивать \n\nОтображаемое количество трафика относиться только к обходу белых списков.".encode('utf-8')).decode('latin-1')
-    response.headers["announce-url"] = "https://t.me/skynetaivpn_bot"
-    response.headers["subscription-userinfo"] = f"expire={int(user.sub_end.timestamp())}; upload={trafic[0]}; download={trafic[1]}; total={trafic[2]}"
-    response.headers["X-Frame-Options"] = 'SAMEORIGIN'
-    response.headers["Referrer-Policy"] = 'no-referrer-when-downgrade'
-    response.headers["X-Content-Type-Options"] = 'nosniff'
-    response.headers["Permissions-Policy"] = 'geolocation=(), microphone=()'
-    response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
-
-
-    return response
+    rendered = RenderedSubscription(subscription_content, headers, valid_until=user.sub_end)
+    if complete:
+        subscription_cache.put(key, user.id, rendered, version)
+    return rendered
 
 
+@app.get("/subscription")
+async def generate_subscription_config(
+    user_token: str,
+    if_none_match: str | None = Header(None)
+):
+    key = ('tg', user_token)
+    rendered = subscription_cache.get(key)
+    if rendered is None:
+        rendered = await subscription_flights.do(key, lambda: _build_subscription(key, user_token))
+
+    return subscription_response(rendered, if_none_match)
@@ -1,19 +1,33 @@
 import os
 
 from collections.abc import AsyncGenerator
+from datetime import datetime, timedelta
 
+from sqlalchemy import Connection, inspect, text, update
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
-from app.database.models import Base
+from app.database.models import Base, Payment
 
 
 engine = create_async_engine(str(os.getenv("DB_URL")), echo=False)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 
+def _add_payment_status(conn: Connection):
+    '''payments.status для баз, созданных до его появления (create_all не добавляет колонки).
+    Старые оплаты считаются выполненными, чтобы повторный колбэк по ним не продлил подписку ещё раз;
+    счета за последние сутки остаются pending — их ещё могут оплатить.'''
+    columns = {column['name'] for column in inspect(conn).get_columns('payments')}
+    if 'status' in columns:
+        return
+    conn.execute(text("ALTER TABLE payments ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'pending'"))
+    conn.execute(update(Payment).where(Payment.created < datetime.now() - timedelta(days=1)).values(status='done'))
+
+
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_payment_status)
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
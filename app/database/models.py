@@ -1,7 +1,7 @@
 import uuid
 
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Integer, Numeric, String, Text, func, nullslast
+from sqlalchemy import JSON, BigInteger, Boolean, DateTime, ForeignKey, Integer, Numeric, String, Text, func, nullslast
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -50,6 +50,8 @@ class Payment(Base):
     user_id = mapped_column(UUID(as_uuid=True), ForeignKey('users.id'))
     tariff_id: Mapped[int] = mapped_column(Integer(), ForeignKey('tariffs.id'))
     recurent: Mapped[bool] = mapped_column(Boolean(), default=False)
+    # выполнение оплаты: pending -> processing (колбэк принят, операции в outbox) -> done / failed
+    status: Mapped[str] = mapped_column(String(20), default='pending', server_default='pending')
     user = relationship(argument="User")
     tariff = relationship(argument="Tariff")
 
@@ -75,8 +77,35 @@ class UserServer(Base):
     server_id: Mapped[int] = mapped_column(Integer, ForeignKey("servers.id"))
 
     server = relationship(argument=Server)
+    # заполняется только явной загрузкой (contains_eager), иначе None
+    traffic = relationship(argument='TrafficSnapshot', uselist=False, viewonly=True, lazy='noload')
 
-   
 
+class TrafficSnapshot(Base):
+    """Трафик клиента need_gb панели (байты), который периодически снимает поллер."""
+    __tablename__ = 'traffic_snapshots'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_server_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey('users_servers.id', ondelete='CASCADE'), unique=True, index=True
+    )
+    up: Mapped[int] = mapped_column(BigInteger, default=0)
+    down: Mapped[int] = mapped_column(BigInteger, default=0)
+    total: Mapped[int] = mapped_column(BigInteger, default=0)
 
 
+class PanelOperation(Base):
+    """Outbox: отложенные операции с панелями и уведомления, которые выполняет фоновый воркер."""
+    __tablename__ = 'panel_operations'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    payment_id: Mapped[int] = mapped_column(Integer, ForeignKey('payments.id'), nullable=True, index=True)
+    server_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    kind: Mapped[str] = mapped_column(String(30), nullable=False)
+    payload: Mapped[dict] = mapped_column(JSON, default=dict)
+    result: Mapped[dict] = mapped_column(JSON, nullable=True)
+    # pending -> processing -> done / failed
+    status: Mapped[str] = mapped_column(String(20), default='pending', index=True)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now())
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
@@ -1,11 +1,14 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional
 from uuid import UUID
-from sqlalchemy import DateTime, delete, select, update
+from sqlalchemy import DateTime, case, delete, func, insert, select, type_coerce, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import query, selectinload
+from sqlalchemy.orm import contains_eager, query, selectinload
 
-from app.database.models import User, UserServer, Server, Payment, Tariff, FAQ
+from app.database.models import User, UserServer, Server, Payment, Tariff, FAQ, PanelOperation, TrafficSnapshot
+from app.utils.panel_registry import panel_registry
 
 
 # User
@@ -98,6 +101,28 @@ async def orm_get_user_by_tgid(session: AsyncSession, telegram_id: int):
     return result.scalar()
 
 
+async def orm_get_user_with_servers(
+        session: AsyncSession,
+        user_id: Optional[UUID] = None,
+        telegram_id: Optional[int] = None
+):
+    '''Пользователь (по id или telegram_id) вместе с users_servers, их Server и TrafficSnapshot одним запросом.
+    Возвращает (user, {server_id: UserServer}); (None, {}), если пользователя нет.'''
+    query = select(User, UserServer).outerjoin(UserServer, UserServer.user_id == User.id).outerjoin(
+        UserServer.server).outerjoin(UserServer.traffic).options(
+        contains_eager(UserServer.server), contains_eager(UserServer.traffic)).order_by(UserServer.id)
+    if user_id is not None:
+        query = query.where(User.id == user_id)
+    else:
+        query = query.where(User.telegram_id == telegram_id)
+
+    rows = (await session.execute(query)).all()
+    if not rows:
+        return None, {}
+    user = rows[0][0]
+    return user, {us.server_id: us for row_user, us in rows if row_user is user and us is not None}
+
+
 # Server
 async def orm_add_server(
         session: AsyncSession,
@@ -117,12 +142,14 @@ async def orm_add_server(
         need_gb=need_gb
     ))
     await session.commit()
+    panel_registry.invalidate()
 
 
 async def orm_delete_server(session: AsyncSession, server_id: int):
     query = delete(Server).where(Server.id == server_id)
     await session.execute(query)
     await session.commit()
+    panel_registry.invalidate()
 
 
 async def orm_update_server(
@@ -133,6 +160,7 @@ async def orm_update_server(
     query = update(Server).where(Server.id == server_id).values(**data)
     await session.execute(query)
     await session.commit()
+    panel_registry.invalidate()
 
 
 async def orm_get_servers(session: AsyncSession):
@@ -168,6 +196,20 @@ async def orm_add_user_server(
     await session.commit()
 
 
+async def orm_add_user_servers(session: AsyncSession, rows: list[dict]):
+    '''Массово добавляет записи users_servers одним INSERT ... RETURNING.
+    rows: [{'tun_id': ..., 'user_id': ..., 'server_id': ...}]
+    Возвращает строки (id, tun_id, user_id) вставленных записей.
+    '''
+    if not rows:
+        return []
+    query = insert(UserServer).returning(UserServer.id, UserServer.tun_id, UserServer.user_id)
+    result = await session.execute(query, rows)
+    inserted = result.all()
+    await session.commit()
+    return inserted
+
+
 async def orm_get_user_servers(session: AsyncSession, user_id: UUID):
     query = select(UserServer).where(UserServer.user_id == user_id)
     result = await session.execute(query)
@@ -198,6 +240,13 @@ async def orm_get_user_servers_by_si(session: AsyncSession, server_id: int):
     return result.scalars().all()
 
 
+async def orm_get_server_user_rows(session: AsyncSession, server_id: int):
+    '''Все записи users_servers сервера вместе с пользователями одним запросом: [(UserServer, User)].'''
+    query = select(UserServer, User).join(User, UserServer.user_id == User.id).where(UserServer.server_id == server_id)
+    result = await session.execute(query)
+    return result.all()
+
+
 async def orm_delete_user_servers_by_si(session: AsyncSession, server_id: str):
     query = delete(UserServer).where(UserServer.server_id == server_id)
     await session.execute(query)
@@ -304,15 +353,17 @@ async def orm_end_payment(session: AsyncSession, id: int):
     await session.commit()
 
 
-async def orm_new_payment(session: AsyncSession, user_id: UUID, tariff_id: int, recurent: bool = False):
-    '''Создает новую запись о платеже в таблицу'''
-    obj = Payment(
+async def orm_new_payment(session: AsyncSession, user_id: UUID, tariff_id: int, recurent: bool = False) -> int:
+    '''Создает новую запись о платеже одним INSERT ... RETURNING и возвращает её id (номер счёта)'''
+    query = insert(Payment).values(
         user_id=user_id,
         tariff_id=tariff_id,
         recurent=recurent,
-    )
-    session.add(obj)
+    ).returning(Payment.id)
+    result = await session.execute(query)
+    payment_id = result.scalar_one()
     await session.commit()
+    return payment_id
 
 
 async def orm_get_payment(session: AsyncSession, payment_id):
@@ -322,13 +373,11 @@ async def orm_get_payment(session: AsyncSession, payment_id):
     return result.scalar()
 
 
-async def orm_get_last_payment_id(session: AsyncSession):
-    '''Возвращает последнюю запись о платеже'''
-    query = select(Payment).order_by(Payment.id.desc()).limit(1)
+async def orm_get_payment_status(session: AsyncSession, payment_id):
+    '''Статус выполнения оплаты без загрузки пользователя (None — оплаты нет)'''
+    query = select(Payment.status).where(Payment.id == payment_id)
     result = await session.execute(query)
-    payment = result.scalar_one_or_none()
-
-    return payment.id if payment else 0
+    return result.scalar()
 
 
 async def orm_get_last_payment(session: AsyncSession, user_id: UUID):
@@ -340,3 +389,182 @@ async def orm_get_last_payment(session: AsyncSession, user_id: UUID):
 
     return payment.id if payment else 0
 
+
+# PanelOperation (outbox)
+async def orm_enqueue_payment(
+        session: AsyncSession,
+        payment_id: int,
+        user_id: UUID,
+        user_values: dict,
+        user_servers: list[dict],
+        operations: list[dict]
+) -> list[PanelOperation] | None:
+    '''Одной транзакцией применяет оплату: захватывает её (pending -> processing), обновляет пользователя,
+    добавляет users_servers и операции для панелей в outbox (panel_operations).
+    Операции над новыми users_servers (тот же tun_id) получают в payload их id и email
+    ({email_prefix}_{id}), чтобы обработчики не перечитывали запись.
+    Возвращает созданные операции; None — оплату уже захватил другой колбэк, ничего не записано.'''
+    claim = update(Payment).where(Payment.id == payment_id).where(
+        Payment.status == 'pending').values(status='processing')
+    if (await session.execute(claim)).rowcount != 1:
+        await session.rollback()
+        return None
+    if user_values:
+        await session.execute(update(User).where(User.id == user_id).values(**user_values))
+    new_user_servers = [UserServer(**row) for row in user_servers]
+    session.add_all(new_user_servers)
+    if new_user_servers:
+        await session.flush()
+    ids = {us.tun_id: us.id for us in new_user_servers}
+    for op in operations:
+        payload = op['payload']
+        if payload.get('tun_id') in ids:
+            user_server_id = ids[payload['tun_id']]
+            op['payload'] = {**payload, 'user_server_id': user_server_id}
+            if 'email_prefix' in payload:
+                op['payload']['email'] = f"{op['payload'].pop('email_prefix')}_{user_server_id}"
+    rows = [PanelOperation(**op) for op in operations]
+    session.add_all(rows)
+    await session.commit()
+    return rows
+
+
+async def orm_get_payment_operations(session: AsyncSession, payment_id: int):
+    query = select(PanelOperation).where(PanelOperation.payment_id == payment_id).order_by(PanelOperation.id)
+    result = await session.execute(query)
+    return result.scalars().all()
+
+
+async def orm_claim_panel_operation(session: AsyncSession, operation_id: Optional[int] = None):
+    '''Забирает в работу одну готовую к выполнению операцию (pending -> processing),
+    с operation_id — только её. Захват — условный UPDATE, поэтому операцию не возьмут два воркера.'''
+    if operation_id is None:
+        query = select(PanelOperation.id).where(PanelOperation.status == 'pending').where(
+            PanelOperation.next_attempt_at <= datetime.now()).order_by(PanelOperation.id).limit(10)
+        candidates = (await session.execute(query)).scalars().all()
+    else:
+        candidates = [operation_id]
+
+    for op_id in candidates:
+        claim = update(PanelOperation).where(PanelOperation.id == op_id).where(
+            PanelOperation.status == 'pending').values(status='processing')
+        claimed = await session.execute(claim)
+        await session.commit()
+        if claimed.rowcount == 1:
+            return await session.get(PanelOperation, op_id)
+    return None
+
+
+async def orm_finish_panel_operation(
+        session: AsyncSession,
+        operation: PanelOperation,
+        status: str,
+        error: Optional[str] = None,
+        next_attempt_at: Optional[datetime] = None
+):
+    operation.status = status
+    operation.last_error = error
+    if next_attempt_at:
+        operation.next_attempt_at = next_attempt_at
+    if operation.payment_id and status in ('done', 'failed'):
+        await session.flush()
+        # последняя операция оплаты завершает и саму оплату: failed, если не выполнилась хоть одна
+        # операция с панелью; недоставленное уведомление оплату не проваливает
+        siblings = select(PanelOperation.id).where(PanelOperation.payment_id == operation.payment_id)
+        unfinished = siblings.where(PanelOperation.status.in_(('pending', 'processing'))).exists()
+        failed = siblings.where(PanelOperation.status == 'failed').where(PanelOperation.kind != 'notify').exists()
+        query = update(Payment).where(Payment.id == operation.payment_id).where(
+            Payment.status == 'processing').where(~unfinished).values(status=case((failed, 'failed'), else_='done'))
+        await session.execute(query)
+    await session.commit()
+
+
+async def orm_requeue_stale_operations(session: AsyncSession, stale_after: float):
+    '''Возвращает в очередь операции, зависшие в processing дольше stale_after секунд
+    (процесс упал посреди выполнения). Время — по часам БД, как и updated.'''
+    db_now = await orm_get_db_now(session)
+    query = update(PanelOperation).where(PanelOperation.status == 'processing').where(
+        PanelOperation.updated < db_now - timedelta(seconds=stale_after)).values(status='pending')
+    result = await session.execute(query)
+    await session.commit()
+    return result.rowcount
+
+
+async def orm_release_panel_operation(session: AsyncSession, operation_id: int):
+    '''Возвращает захваченную операцию в очередь (выполнение прервано остановкой процесса).'''
+    query = update(PanelOperation).where(PanelOperation.id == operation_id).where(
+        PanelOperation.status == 'processing').values(status='pending')
+    await session.execute(query)
+    await session.commit()
+
+
+# TrafficSnapshot
+def _db_clock(session: AsyncSession):
+    '''Текущее время БД. В postgresql now() — начало транзакции, поэтому clock_timestamp();
+    в sqlite — строка в формате, в котором SQLAlchemy пишет DateTime, чтобы сравнения были точными.'''
+    if session.bind.dialect.name == 'postgresql':
+        return func.clock_timestamp().cast(DateTime)
+    return type_coerce(func.strftime('%Y-%m-%d %H:%M:%f000', 'now'), DateTime)
+
+
+async def orm_get_db_now(session: AsyncSession) -> datetime:
+    '''Время БД на момент вызова; транзакция сразу закрывается, чтобы не держать её открытой.'''
+    db_now = await session.scalar(select(_db_clock(session)))
+    await session.commit()
+    return db_now
+
+
+async def orm_upsert_traffic_snapshots(
+        session: AsyncSession, rows: list[dict], fetched_at: datetime | None = None, chunk_size: int = 1000
+):
+    '''Массовый upsert трафика: rows [{'user_server_id', 'up', 'down', 'total'}].
+    INSERT ... ON CONFLICT (user_server_id) DO UPDATE — для postgresql и sqlite.
+    fetched_at — время БД перед запросом к панели: снимки, изменённые позже (remember_total_gb),
+    устаревшими данными не перезаписываются.'''
+    if not rows:
+        return
+    dialect_insert = postgresql_insert if session.bind.dialect.name == 'postgresql' else sqlite_insert
+    query = dialect_insert(TrafficSnapshot)
+    query = query.on_conflict_do_update(
+        index_elements=[TrafficSnapshot.user_server_id],
+        set_={
+            'up': query.excluded.up,
+            'down': query.excluded.down,
+            'total': query.excluded.total,
+            'updated': _db_clock(session),
+        },
+        where=TrafficSnapshot.updated < fetched_at if fetched_at is not None else None
+    )
+    for start in range(0, len(rows), chunk_size):
+        await session.execute(query, rows[start:start + chunk_size])
+    await session.commit()
+
+
+async def orm_get_traffic_snapshot(session: AsyncSession, user_server_id: int):
+    query = select(TrafficSnapshot).where(TrafficSnapshot.user_server_id == user_server_id)
+    result = await session.execute(query)
+    return result.scalar()
+
+
+async def orm_set_traffic_total(session: AsyncSession, user_server_id: int, total: int):
+    '''Записывает новый лимит (байты) после изменения клиента, не дожидаясь поллера.'''
+    query = (
+        update(TrafficSnapshot)
+        .where(TrafficSnapshot.user_server_id == user_server_id)
+        .values(total=total, updated=_db_clock(session))
+    )
+    await session.execute(query)
+    await session.commit()
+
+
+async def orm_reset_traffic_snapshots(session: AsyncSession, server_id: int):
+    '''Обнуляет up/down снимков всех клиентов сервера (после resetAllClientTraffics).'''
+    user_server_ids = select(UserServer.id).where(UserServer.server_id == server_id)
+    query = (
+        update(TrafficSnapshot)
+        .where(TrafficSnapshot.user_server_id.in_(user_server_ids))
+        .values(up=0, down=0, updated=_db_clock(session))
+    )
+    await session.execute(query)
+    await session.commit()
+
@@ -1,3 +1,4 @@
+import asyncio
 from datetime import date, datetime, time
 import os
 import json
@@ -19,35 +20,38 @@ from app.database.engine import get_async_session, async_session_maker
 from app.setup_logger import logger
 from app.tg_bot_router.bot import bot
 from app.database.queries import (
-    orm_add_user_server,
-    orm_change_user_tariff,
     orm_get_last_payment,
     orm_get_payment,
-    orm_get_server,
-    orm_get_servers,
+    orm_get_payment_status,
     orm_get_tariff,
-    orm_get_last_payment_id,
     orm_get_user,
     orm_get_user_by_tgid,
-    orm_get_user_server,
     orm_get_user_server_by_ti,
     orm_get_user_servers,
+    orm_get_user_servers_by_si,
     orm_new_payment,
-    orm_update_user,
+    orm_enqueue_payment,
+    orm_get_payment_operations,
     orm_get_subscribers,
-    orm_get_users
+    orm_get_users,
+    orm_reset_traffic_snapshots
 )
-from app.utils.three_x_ui_api import ThreeXUIServer
+from app.database.models import PanelOperation, UserServer
+from app.utils.outbox import OperationDeferred, OperationFailed, outbox
+from app.utils.subscription import warm_subscription
+from app.utils.subscription_cache import subscription_cache
+from app.utils.three_x_ui_api import ThreeXUIServer, get_panel, get_panels
+from app.utils.traffic_poller import GB, known_total_bytes, remember_total_gb
 
 
 payment_router = APIRouter(prefix="/payment")
 templates = Jinja2Templates(directory='app/payment_router/templates')
 
 
-async def preserve_total_gb(panel: ThreeXUIServer, *, uuid: str, tariff_gb: int) -> int:
+async def preserve_total_gb(session: AsyncSession, panel: ThreeXUIServer, user_server: UserServer, *, tariff_gb: int) -> int:
     """
     На need_gb панелях НЕ уменьшаем лимит:
-    ставим max(текущий лимит в панели, тарифный лимит или 30).
+    ставим max(текущий лимит из traffic_snapshots, тарифный лимит или 30).
     На остальных панелях возвращаем 0.
     """
     if not panel.need_gb:
@@ -55,7 +59,7 @@ async def preserve_total_gb(panel: ThreeXUIServer, *, uuid: str, tariff_gb: int)
 
     base_gb = int(tariff_gb) if tariff_gb else 30
     try:
-        current_gb = await panel.get_total_gb(uuid)
+        current_gb = int((await known_total_bytes(session, panel, user_server) or 0) // GB)
     except Exception:
         current_gb = 0
 
@@ -74,7 +78,8 @@ async def payment_page(
     if not tariff or not user:
         raise HTTPException(status_code=404, detail="Tariff or User not found")
 
-    invoice_id = await orm_get_last_payment_id(session) + 1
+    # номер счёта — id вставленной записи, без гонки между одновременными оплатами
+    invoice_id = await orm_new_payment(session, tariff_id=tariff.id, user_id=user.id)
 
     # Если days=0 и ips=0 — считаем это доп.продуктом (докупка трафика).
     is_addon = (tariff.days == 0 and tariff.ips == 0)
@@ -101,8 +106,6 @@ async def payment_page(
     base_string = f"{os.getenv('SHOP_ID')}:{tariff.price}:{invoice_id}:{json.dumps(receipt, ensure_ascii=False)}:{os.getenv('PASSWORD_1')}"
     signature_value = hashlib.md5(base_string.encode("utf-8")).hexdigest()
 
-    await orm_new_payment(session, tariff_id=tariff.id, user_id=user.id)
-
     return templates.TemplateResponse(
         "/payment_page.html",
         {
@@ -118,6 +121,10 @@ async def payment_page(
     )
 
 
+def _operation(payment, kind: str, server_id: int | None = None, **payload) -> dict:
+    return {'payment_id': payment.id, 'server_id': server_id, 'kind': kind, 'payload': payload}
+
+
 @payment_router.post("/get_payment")
 async def choose_server(
     OutSum: Union[str, float, int] = Form(...),
@@ -130,137 +137,65 @@ async def choose_server(
     Shp_Receipt: Union[str, None] = Form(None),
     session: AsyncSession = Depends(get_async_session)
 ):
-    payment = await orm_get_payment(session, int(InvId))
-    if not payment:
+    """
+    Колбэк Robokassa. Изменения пользователя и операции с панелями фиксируются
+    одной транзакцией (outbox), сами панели (конкурентно) и сообщение в Telegram — в фоне,
+    поэтому ответ OK{InvId} уходит сразу. Оплата выполняется один раз: её захват
+    (pending -> processing) — в той же транзакции, повторные колбэки получают OK без записи.
+    """
+    # повторный колбэк (Robokassa не дождалась OK): оплата уже принята — сразу OK, без записи
+    status = await orm_get_payment_status(session, int(InvId))
+    if status is None:
         raise HTTPException(status_code=404, detail="Оплата не найдена")
+    if status != 'pending':
+        logger.info(f"Повторный колбэк оплаты {InvId}, статус {status}")
+        return f'OK{InvId}'
 
-    user = payment.user
+    payment = await orm_get_payment(session, int(InvId))
 
-    try:
-        await orm_update_user(session, user.id, {'email': EMail})
-    except Exception:
-        logger.error("Не удалось сменить почту пользователя")
+    user = payment.user
 
     tariff = await orm_get_tariff(session, payment.tariff_id)
     if not tariff:
         raise HTTPException(status_code=404, detail="Tariff not found")
 
     user_servers = await orm_get_user_servers(session, user.id)
-    servers = await orm_get_servers(session)
-
-    threex_panels = []
-    for s in servers:
-        threex_panels.append(ThreeXUIServer(
-            s.id,
-            s.url,
-            s.indoub_id,
-            s.login,
-            s.password,
-            s.need_gb,
-            s.name,  # важно для единого формата email
-        ))
+    user_servers_by_si = {us.server_id: us for us in user_servers}
+    threex_panels = await get_panels(session)
 
     is_addon = (tariff.days == 0 and tariff.ips == 0)
 
+    user_values = {'email': EMail}
+    new_user_servers = []
+    operations = []
+
     # --- ДОП ПРОДУКТ: докупка трафика (накопительно: current + add) ---
     if (not payment.recurent) and is_addon and (tariff.trafic or 0) > 0:
         now = datetime.now()
         if not user.sub_end or user.sub_end < now:
-            await bot.send_message(
-                user.telegram_id,
-                "❌ Докупить трафик можно только при активной подписке.\n\n"
-                "Открой /start → 🛍 Купить подписку.",
-                parse_mode='HTML'
-            )
-            return f'OK{InvId}'
-
-        add_gb = int(tariff.trafic)
-
-        # Берём текущий лимит (в ГБ) по панелям need_gb и прибавляем add_gb.
-        # Чтобы не урезать нигде — берём максимальный текущий лимит среди need_gb панелей.
-        limits = []
-        for panel in threex_panels:
-            if not panel.need_gb:
-                continue
-            us = await orm_get_user_server(session, user.id, panel.id)
-            if not us:
-                continue
-            try:
-                cur_gb = await panel.get_total_gb(us.tun_id)
-                if cur_gb > 0:
-                    limits.append(cur_gb)
-            except Exception as e:
-                logger.error(f"[EXTRA_GB] Не удалось прочитать текущий лимит user={user.telegram_id} panel={panel.id}: {e}")
-
-        current_limit_gb = max(limits) if limits else 30
-        new_limit_gb = current_limit_gb + add_gb
-
-        GB = 1073741824
-        add_gb = int(tariff.trafic)
-
-        changed = 0
-        for panel in threex_panels:
-            if not panel.need_gb:
-                continue
-
-            try:
-                us = await orm_get_user_server(session, user.id, panel.id)
-                if not us:
+            operations.append(_operation(payment, 'notify', template='addon_denied'))
+        else:
+            add_gb = int(tariff.trafic)
+            for panel in threex_panels:
+                us = user_servers_by_si.get(panel.id)
+                if not panel.need_gb or not us:
                     continue
-
-                email = f"{panel.name}_{us.id}"
-
-                # читаем up/down/total (байты)
-                traf = await panel.client_remain_trafic(us.tun_id)
-                if not traf:
-                    # если не смогли прочитать — хотя бы увеличим от 30
-                    current_total_bytes = 30 * GB
-                else:
-                    up, down, total = traf
-                    current_total_bytes = int(total or 0)
-                    # страховка: минимум 30ГБ
-                    if current_total_bytes < 30 * GB:
-                        current_total_bytes = 30 * GB
-
-                new_total_bytes = current_total_bytes + add_gb * GB
-                new_total_gb = int(new_total_bytes // GB)
-
-                await panel.edit_client(
-                    uuid=us.tun_id,
-                    email=email,
+                # текущий лимит читается в воркере, перед самим изменением
+                operations.append(_operation(
+                    payment, 'add_traffic', panel.id,
+                    tun_id=us.tun_id,
+                    user_server_id=us.id,
+                    email=f"{panel.name}_{us.id}",
+                    add_gb=add_gb,
                     limit_ip=user.ips,
                     expiry_time=int(user.sub_end.timestamp() * 1000),
                     tg_id=user.telegram_id,
                     name=user.name,
-                    total_gb=new_total_gb,
-                )
-
-                changed += 1
-            except Exception as e:
-                logger.error(f"[EXTRA_GB] Не удалось применить докупку user={user.telegram_id} panel={panel.id}: {e}")
-
-        url = f"{os.getenv('URL')}/api/subscribtion?user_token={user.id}"
-
-        await bot.send_message(
-            user.telegram_id,
-            (
-                "✅ <b>Трафик добавлен!</b>\n\n"
-                f"📦 Было: <b>{current_limit_gb} ГБ</b>\n"
-                f"➕ Добавлено: <b>{add_gb} ГБ</b>\n"
-                f"🏳️ Стало: <b>{new_limit_gb} ГБ</b>\n\n"
-                "<b>Ваша ссылка на ключ. 🔑</b>\n\n"
-                "Нажмите 1 раз чтобы скопировать:\n\n"
-                f"<pre><code>{url}</code></pre>"
-            ),
-            parse_mode="HTML",
-            reply_markup=succes_pay_btns_for_gb(user),
-        )
-
-        logger.info(f"[EXTRA_GB] user={user.telegram_id} add={add_gb} from={current_limit_gb} to={new_limit_gb} panels_changed={changed}")
-        return f'OK{InvId}'
+                ))
+            operations.append(_operation(payment, 'notify', template='addon', add_gb=add_gb))
 
     # --- Обычная покупка/продление тарифа ---
-    if not payment.recurent:
+    elif not payment.recurent:
 
         # первая покупка (серверов ещё нет)
         if not user_servers:
@@ -269,35 +204,19 @@ async def choose_server(
             end_timestamp = int(end_datetime.timestamp() * 1000)
 
             for panel in threex_panels:
-                uuid = uuid4()
-                await orm_add_user_server(
-                    session,
-                    server_id=panel.id,
-                    tun_id=str(uuid),
-                    user_id=user.id,
-                )
-                user_server = await orm_get_user_server_by_ti(session, str(uuid))
-                server = await orm_get_server(session, user_server.server_id)
-
-                email = server.name + '_' + str(user_server.id)
-
-                await panel.add_client(
-                    uuid=str(uuid),
-                    email=email,
+                uuid = str(uuid4())
+                new_user_servers.append({'server_id': panel.id, 'tun_id': uuid, 'user_id': user.id})
+                # user_server_id и email допишет orm_enqueue_payment после flush
+                operations.append(_operation(
+                    payment, 'add_client', panel.id,
+                    tun_id=uuid,
+                    email_prefix=panel.name,
                     limit_ip=tariff.ips,
                     expiry_time=end_timestamp,
                     tg_id=user.telegram_id,
                     name=user.name,
-                    total_gb=30 if panel.need_gb else 0
-                )
-
-            await orm_change_user_tariff(
-                session,
-                ips=tariff.ips,
-                tariff_id=tariff.id,
-                user_id=user.id,
-                sub_end=end_datetime
-            )
+                    total_gb=30 if panel.need_gb else 0,
+                ))
 
         # продление/смена тарифа (серверы уже есть) — НЕ уменьшаем totalGB
         else:
@@ -309,41 +228,24 @@ async def choose_server(
             end_timestamp = int(end_datetime.timestamp() * 1000)
 
             for panel in threex_panels:
-                user_server = await orm_get_user_server(session, user.id, panel.id)
-                server = await orm_get_server(session, user_server.server_id)
-
-                total_gb = await preserve_total_gb(panel, uuid=user_server.tun_id, tariff_gb=int(tariff.trafic or 0))
-
-                await panel.edit_client(
-                    uuid=user_server.tun_id,
-                    email=server.name + '_' + str(user_server.id),
+                us = user_servers_by_si.get(panel.id)
+                if not us:
+                    logger.warning(f"Нет записи сервера {panel.id} у пользователя {user.telegram_id}, продление пропущено")
+                    continue
+                operations.append(_operation(
+                    payment, 'edit_client', panel.id,
+                    tun_id=us.tun_id,
+                    user_server_id=us.id,
+                    email=f"{panel.name}_{us.id}",
                     limit_ip=tariff.ips,
-                    name=user.name,
                     expiry_time=end_timestamp,
                     tg_id=user.telegram_id,
-                    total_gb=total_gb,
-                )
-
-            await orm_change_user_tariff(
-                session,
-                ips=tariff.ips,
-                tariff_id=tariff.id,
-                user_id=user.id,
-                sub_end=end_datetime
-            )
-
-        url = f"{os.getenv('URL')}/api/subscribtion?user_token={user.id}"
+                    name=user.name,
+                    tariff_gb=int(tariff.trafic or 0),
+                ))
 
-        await bot.send_message(
-            user.telegram_id,
-            f"<b>✅ Спасибо! Вы оформили подписку!</b>\n\n"
-            f"🗓 Ваша подписка активна до {user.sub_end.date().strftime('%d.%m.%Y')}\n\n"
-            f"<b>Для автоматического подключения нажмите кнопку \"Подключиться\"\n\n"
-            f"Для ручного ввода скопируйте ключ. Для копирования ключа нажмите на него 1 раз. ⬇️</b>\n\n"
-            f"<pre><code>{url}</code></pre>",
-            reply_markup=succes_pay_btns(user),
-            parse_mode='HTML'
-        )
+        user_values.update(ips=tariff.ips, tariff_id=tariff.id, sub_end=end_datetime)
+        operations.append(_operation(payment, 'notify', template='purchase', sub_end=end_datetime.strftime('%d.%m.%Y')))
 
     # --- Рекуррентное продление — НЕ уменьшаем totalGB ---
     else:
@@ -352,34 +254,210 @@ async def choose_server(
         end_timestamp = int(end_datetime.timestamp() * 1000)
 
         for panel in threex_panels:
-            user_server = await orm_get_user_server(session, user.id, panel.id)
-
-            total_gb = await preserve_total_gb(panel, uuid=user_server.tun_id, tariff_gb=int(tariff.trafic or 0))
-
-            await panel.edit_client(
-                uuid=user_server.tun_id,
+            us = user_servers_by_si.get(panel.id)
+            if not us:
+                logger.warning(f"Нет записи сервера {panel.id} у пользователя {user.telegram_id}, автопродление пропущено")
+                continue
+            operations.append(_operation(
+                payment, 'edit_client', panel.id,
+                tun_id=us.tun_id,
+                user_server_id=us.id,
                 email=user.name,
                 limit_ip=tariff.ips,
                 expiry_time=end_timestamp,
                 tg_id=user.telegram_id,
                 name=user.name,
-                total_gb=total_gb,
-            )
+                tariff_gb=int(tariff.trafic or 0),
+            ))
+
+        user_values.update(ips=tariff.ips, tariff_id=tariff.id, sub_end=end_datetime)
+        operations.append(_operation(
+            payment, 'notify', template='renewal',
+            sub_end=end_datetime.strftime('%d.%m.%Y'), price=str(tariff.price)
+        ))
 
-        await orm_change_user_tariff(
-            session,
-            ips=tariff.ips,
-            tariff_id=tariff.id,
-            user_id=user.id,
-            sub_end=end_datetime
+    # одновременный колбэк успел захватить оплату раньше
+    enqueued = await orm_enqueue_payment(session, payment.id, user.id, user_values, new_user_servers, operations)
+    if enqueued is None:
+        logger.info(f"Оплата {InvId} уже принята другим колбэком")
+        return f'OK{InvId}'
+    subscription_cache.invalidate_user(user.id)
+    # панели — конкурентно и сразу, уведомление — после них
+    outbox.dispatch(
+        [op.id for op in enqueued if op.kind != 'notify'],
+        [op.id for op in enqueued if op.kind == 'notify'],
+    )
+    logger.info(f"Оплата {payment.id} принята, операций в очереди: {len(operations)}")
+    return f'OK{InvId}'
+
+
+async def _operation_target(session: AsyncSession, operation: PanelOperation):
+    panel = await get_panel(session, operation.server_id)
+    if panel is None:
+        raise OperationFailed(f"сервер {operation.server_id} не найден")
+    p = operation.payload
+    if 'user_server_id' in p:
+        # id записан при постановке: users_servers не перечитываем (объект не сохраняется в сессию)
+        return panel, UserServer(id=p['user_server_id'], tun_id=p['tun_id'], server_id=operation.server_id)
+    # операции, поставленные до появления user_server_id в payload
+    user_server = await orm_get_user_server_by_ti(session, p['tun_id'])
+    if user_server is None:
+        raise OperationFailed(f"нет записи users_servers для {p['tun_id']}")
+    return panel, user_server
+
+
+async def outbox_add_client(session: AsyncSession, operation: PanelOperation):
+    p = operation.payload
+    panel, user_server = await _operation_target(session, operation)
+
+    if operation.attempts:
+        # прошлая попытка могла дойти до панели, а ответ — потеряться
+        snapshot = await panel.get_inbound(force=True)
+        if snapshot is not None and snapshot.find_client(p['tun_id']) is not None:
+            return None
+
+    ok = await panel.add_client(
+        uuid=p['tun_id'],
+        email=p.get('email') or f"{panel.name}_{user_server.id}",
+        limit_ip=p['limit_ip'],
+        expiry_time=p['expiry_time'],
+        tg_id=p['tg_id'],
+        name=p['name'],
+        total_gb=p['total_gb']
+    )
+    if not ok:
+        raise OperationFailed(f"addClient на {panel.url}")
+
+
+async def outbox_edit_client(session: AsyncSession, operation: PanelOperation):
+    p = operation.payload
+    panel, user_server = await _operation_target(session, operation)
+
+    total_gb = p.get('total_gb', 0)
+    if 'tariff_gb' in p:
+        total_gb = await preserve_total_gb(session, panel, user_server, tariff_gb=p['tariff_gb'])
+
+    ok = await panel.edit_client(
+        uuid=p['tun_id'],
+        email=p.get('email') or f"{panel.name}_{user_server.id}",
+        limit_ip=p['limit_ip'],
+        expiry_time=p['expiry_time'],
+        tg_id=p['tg_id'],
+        name=p['name'],
+        total_gb=total_gb,
+    )
+    if not ok:
+        raise OperationFailed(f"updateClient на {panel.url}")
+    if panel.need_gb:
+        await remember_total_gb(session, user_server, total_gb)
+
+
+async def outbox_add_traffic(session: AsyncSession, operation: PanelOperation):
+    """Докупка трафика: новый лимит = текущий (не меньше 30ГБ) + add_gb."""
+    p = operation.payload
+    panel, user_server = await _operation_target(session, operation)
+
+    # лимит считаем один раз: при повторе не прибавляем докупку второй раз
+    result = operation.result
+    if not result:
+        total = await known_total_bytes(session, panel, user_server)
+        if total is None:
+            raise OperationFailed(f"не удалось прочитать трафик {panel.url}")
+
+        current_total_bytes = max(int(total or 0), 30 * GB)
+        result = {
+            'from_gb': int((total or 0) // GB),
+            'to_gb': int((current_total_bytes + p['add_gb'] * GB) // GB),
+        }
+        operation.result = result
+        await session.commit()
+
+    ok = await panel.edit_client(
+        uuid=p['tun_id'],
+        email=p.get('email') or f"{panel.name}_{user_server.id}",
+        limit_ip=p['limit_ip'],
+        expiry_time=p['expiry_time'],
+        tg_id=p['tg_id'],
+        name=p['name'],
+        total_gb=result['to_gb'],
+    )
+    if not ok:
+        raise OperationFailed(f"updateClient на {panel.url}")
+    await remember_total_gb(session, user_server, result['to_gb'])
+    logger.info(f"[EXTRA_GB] user={p['tg_id']} panel={panel.id} {result['from_gb']} -> {result['to_gb']} ГБ")
+    return result
+
+
+async def outbox_notify(session: AsyncSession, operation: PanelOperation):
+    """Сообщение об оплате — после того, как отработали все операции с панелями по ней."""
+    siblings = [op for op in await orm_get_payment_operations(session, operation.payment_id) if op.id != operation.id]
+    if any(op.status in ('pending', 'processing') for op in siblings):
+        raise OperationDeferred("ждём операции с панелями")
+
+    failed = [op.id for op in siblings if op.status == 'failed']
+    if failed:
+        logger.error(f"Оплата {operation.payment_id}: не выполнены операции {failed}")
+
+    p = operation.payload
+    payment = await orm_get_payment(session, operation.payment_id)
+    user = payment.user
+
+    # панели обновлены — пересобираем подписку заранее, к моменту перехода по ссылке
+    subscription_cache.invalidate_user(user.id)
+    if p['template'] != 'addon_denied':
+        await warm_subscription(session, user.id)
+
+    if p['template'] == 'addon_denied':
+        await bot.send_message(
+            user.telegram_id,
+            "❌ Докупить трафик можно только при активной подписке.\n\n"
+            "Открой /start → 🛍 Купить подписку.",
+            parse_mode='HTML'
         )
 
+    elif p['template'] == 'addon':
+        add_gb = p['add_gb']
+        limits = [op.result['from_gb'] for op in siblings if op.kind == 'add_traffic' and op.result and op.result['from_gb'] > 0]
+        current_limit_gb = max(limits) if limits else 30
+        new_limit_gb = current_limit_gb + add_gb
+
+        url = f"{os.getenv('URL')}/api/subscribtion?user_token={user.id}"
+        await bot.send_message(
+            user.telegram_id,
+            (
+                "✅ <b>Трафик добавлен!</b>\n\n"
+                f"📦 Было: <b>{current_limit_gb} ГБ</b>\n"
+                f"➕ Добавлено: <b>{add_gb} ГБ</b>\n"
+                f"🏳️ Стало: <b>{new_limit_gb} ГБ</b>\n\n"
+                "<b>Ваша ссылка на ключ. 🔑</b>\n\n"
+                "Нажмите 1 раз чтобы скопировать:\n\n"
+                f"<pre><code>{url}</code></pre>"
+            ),
+            parse_mode="HTML",
+            reply_markup=succes_pay_btns_for_gb(user),
+        )
+        logger.info(f"[EXTRA_GB] user={user.telegram_id} add={add_gb} from={current_limit_gb} to={new_limit_gb} panels_changed={len(siblings) - len(failed)}")
+
+    elif p['template'] == 'purchase':
+        url = f"{os.getenv('URL')}/api/subscribtion?user_token={user.id}"
+        await bot.send_message(
+            user.telegram_id,
+            f"<b>✅ Спасибо! Вы оформили подписку!</b>\n\n"
+            f"🗓 Ваша подписка активна до {p['sub_end']}\n\n"
+            f"<b>Для автоматического подключения нажмите кнопку \"Подключиться\"\n\n"
+            f"Для ручного ввода скопируйте ключ. Для копирования ключа нажмите на него 1 раз. ⬇️</b>\n\n"
+            f"<pre><code>{url}</code></pre>",
+            reply_markup=succes_pay_btns(user),
+            parse_mode='HTML'
+        )
+
+    elif p['template'] == 'renewal':
         url = f"{os.getenv('URL')}/api/get_sub?token={user.id}"
         await bot.send_message(
             user.telegram_id,
             f"<b>🔄 Ваша подписка успешно продлена!</b>\n\n"
-            f"🗓 Подписка активна до {end_datetime.strftime('%d.%m.%Y')}\n"
-            f"💰 Сумма списания: {tariff.price}₽\n\n"
+            f"🗓 Подписка активна до {p['sub_end']}\n"
+            f"💰 Сумма списания: {p['price']}₽\n\n"
             f"<b>Для автоматического подключения нажмите кнопку \"Подключиться\"\n\n"
             f"Для ручного ввода скопируйте ключ. Для копирования ключа нажмите на него 1 раз. ⬇️</b>\n"
             f"<code>{url}</code>",
@@ -387,7 +465,11 @@ async def choose_server(
             parse_mode='HTML'
         )
 
-    return f'OK{InvId}'
+
+outbox.register('add_client', outbox_add_client)
+outbox.register('edit_client', outbox_edit_client)
+outbox.register('add_traffic', outbox_add_traffic)
+outbox.register('notify', outbox_notify)
 
 
 # ниже — твои функции check_subscription_expiry / recurent_payment / reset_monthly_traffic / notify_expired_users
@@ -486,13 +568,12 @@ async def recurent_payment(bot: Bot):
                 continue
 
             # Создаём новый рекуррентный платёж (УЖЕ на renew_tariff_id)
-            await orm_new_payment(
+            invoice_id = await orm_new_payment(
                 session,
                 tariff_id=renew_tariff_id,
                 user_id=user.id,
                 recurent=True
             )
-            invoice_id = await orm_get_last_payment_id(session)
 
             # 📌 Описание в чеке (то, что ты просила "в описании тарифа")
             item_name = f"Подписка SkynetVPN на {days_to_str(tariff.days)}"
@@ -554,94 +635,96 @@ async def reset_monthly_traffic(bot: Bot):
     """Ежемесячный сброс трафика на сервере обхода белых списков.
     Для тех, у кого был докупленный/увеличенный лимит (>30ГБ):
     новый лимит = (остаток в байтах) + 30ГБ, затем reset usage.
+    На панель — один inbounds/get, правки только клиентов с докупкой
+    и один resetAllClientTraffics на весь inbound.
     """
     async with async_session_maker() as session:
         users = await orm_get_users(session)
-        servers = await orm_get_servers(session)
         today = datetime.now()
 
-        panels = []
-        for s in servers:
-            if s.need_gb:
-                panels.append(ThreeXUIServer(
-                    s.id, s.url, s.indoub_id, s.login, s.password, s.need_gb, s.name
-                ))
+        panels = [panel for panel in await get_panels(session) if panel.need_gb]
 
         if not panels:
             logger.info("Нет серверов с need_gb для сброса трафика")
             return
 
-        GB = 1073741824
+        active_users = {user.id: user for user in users if user.sub_end and user.sub_end >= today}
+
         reset_count = 0
         bonus_count = 0
 
-        for user in users:
-            if not user.sub_end or user.sub_end < today:
+        for panel in panels:
+            inbound = await panel.get_inbound(force=True)
+            if inbound is None:
+                logger.error(f"Не удалось получить трафик панели {panel.name} для сброса")
                 continue
 
-            user_servers = await orm_get_user_servers(session, user.id)
+            user_servers = await orm_get_user_servers_by_si(session, panel.id)
 
+            bonuses = []
             for us in user_servers:
-                for panel in panels:
-                    if panel.id != us.server_id:
-                        continue
-
-                    email = f"{panel.name}_{us.id}"
-
-                    try:
-                        traf = await panel.client_remain_trafic(us.tun_id)
-                        if not traf:
-                            break
-
-                        up, down, total = traf
-                        up = up or 0
-                        down = down or 0
-                        total = total or 0
-
-                        # остаток в байтах
-                        used = up + down
-                        remaining = total - used
-                        if remaining < 0:
-                            remaining = 0
-
-                        # признак "есть докупка": лимит больше 30ГБ
-                        total_gb = int(total // GB)
-
-                        if total_gb > 30:
-                            # хотим: остаток + 30ГБ => новый лимит в ГБ
-                            new_total_bytes = remaining + (30 * GB)
-                            new_total_gb = int(new_total_bytes // GB)
-
-                            # берём текущие параметры клиента, чтобы ничего не сломать
-                            client = await panel.get_client_by_uuid(us.tun_id)
-                            if not client:
-                                logger.warning(f"Не найден клиент для бонуса: tg={user.telegram_id} panel={panel.id} uuid={us.tun_id}")
-                            else:
-                                await panel.edit_client(
-                                    uuid=us.tun_id,
-                                    name=client.get("comment") or user.name,
-                                    email=client.get("email") or email,
-                                    limit_ip=int(client.get("limitIp") or user.ips or 1),
-                                    expiry_time=int(client.get("expiryTime") or int(user.sub_end.timestamp() * 1000)),
-                                    tg_id=str(client.get("tgId") or user.telegram_id),
-                                    total_gb=new_total_gb,
-                                )
-                                bonus_count += 1
-                                logger.info(
-                                    f"Бонус +30ГБ от остатка: tg={user.telegram_id} panel={panel.name} "
-                                    f"total={total_gb}GB used={(used//GB)}GB remaining={(remaining//GB)}GB -> new_total={new_total_gb}GB"
-                                )
-
-                        # reset usage (после него "остаток" станет равен новому лимиту)
-                        result = await panel.reset_client_traffic(email)
-                        if result:
-                            reset_count += 1
-                            logger.info(f"Сброшен трафик для {user.name} на {panel.name}")
-
-                    except Exception as e:
-                        logger.error(f"Ошибка сброса/бонуса трафика для {user.name} ({user.telegram_id}): {e}")
-
-                    break  # нашли панель для этого us
+                user = active_users.get(us.user_id)
+                if not user:
+                    continue
+
+                traf = inbound.traffics.get(us.tun_id)
+                if not traf:
+                    continue
+
+                up, down, total = traf
+
+                # остаток в байтах
+                used = up + down
+                remaining = total - used
+                if remaining < 0:
+                    remaining = 0
+
+                # признак "есть докупка": лимит больше 30ГБ
+                total_gb = int(total // GB)
+                if total_gb <= 30:
+                    continue
+
+                # хотим: остаток + 30ГБ => новый лимит в ГБ
+                new_total_gb = int((remaining + (30 * GB)) // GB)
+
+                # берём текущие параметры клиента, чтобы ничего не сломать
+                client = inbound.clients.get(us.tun_id)
+                if not client:
+                    logger.warning(f"Не найден клиент для бонуса: tg={user.telegram_id} panel={panel.id} uuid={us.tun_id}")
+                    continue
+
+                logger.info(
+                    f"Бонус +30ГБ от остатка: tg={user.telegram_id} panel={panel.name} "
+                    f"total={total_gb}GB used={(used//GB)}GB remaining={(remaining//GB)}GB -> new_total={new_total_gb}GB"
+                )
+                bonuses.append((us, new_total_gb, panel.edit_client(
+                    uuid=us.tun_id,
+                    name=client.get("comment") or user.name,
+                    email=client.get("email") or f"{panel.name}_{us.id}",
+                    limit_ip=int(client.get("limitIp") or user.ips or 1),
+                    expiry_time=int(client.get("expiryTime") or int(user.sub_end.timestamp() * 1000)),
+                    tg_id=str(client.get("tgId") or user.telegram_id),
+                    total_gb=new_total_gb,
+                )))
+
+            # правки лимитов идут пачкой (edit_queue), до сброса usage
+            results = await asyncio.gather(*(edit for _, _, edit in bonuses), return_exceptions=True)
+            for (us, new_total_gb, _), result in zip(bonuses, results):
+                if result is True:
+                    bonus_count += 1
+                    await remember_total_gb(session, us, new_total_gb)
+                else:
+                    logger.error(f"Не удалось применить бонус трафика {panel.name}_{us.id}: {result}")
+
+            # reset usage всем клиентам inbound (после него "остаток" станет равен новому лимиту)
+            if await panel.reset_all_client_traffic():
+                reset_count += len(user_servers)
+                await orm_reset_traffic_snapshots(session, panel.id)
+            else:
+                logger.error(f"Не удалось сбросить трафик панели {panel.name}")
+
+            for user_id in {us.user_id for us in user_servers}:
+                subscription_cache.invalidate_user(user_id)
 
         logger.info(f"Ежемесячный сброс завершён. Сброшено: {reset_count}, бонусов применено: {bonus_count}")
 
@@ -1,29 +1,29 @@
-import base64
-from urllib.parse import quote
 from datetime import datetime
 from uuid import UUID
-from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi import APIRouter, Depends, Header, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 
-from app.database.engine import get_async_session
+from app.database.engine import async_session_maker, get_async_session
 from app.utils.days_to_month import days_to_str
 from app.tg_bot_router.bot import bot
 from app.skynet_api_router.schemas import UpdateClientGS
 from app.setup_logger import logger
 from app.database.queries import (
-    orm_get_server,
-    orm_get_servers,
     orm_get_subscribers,
     orm_get_user_by_tgid,
     orm_get_user_servers, 
     orm_get_users,
     orm_get_tariffs,
-    orm_get_user,
+    orm_get_user_with_servers,
     orm_get_admins,
     orm_update_user
 )
-from app.utils.three_x_ui_api import ThreeXUIServer
+from app.utils.three_x_ui_api import get_panels
+from app.utils.panel_registry import panel_registry
+from app.utils.subscription import SubscriptionUnavailable, render_subscription, subscription_flights, subscription_response
+from app.utils.subscription_cache import RenderedSubscription, subscription_cache
+from app.utils.traffic_poller import GB, known_total_bytes, remember_total_gb
 
 
 api_router = APIRouter(prefix='/api')
@@ -57,6 +57,12 @@ async def get_clients(session: AsyncSession = Depends(get_async_session)):
     return result
 
 
+@api_router.get('/panels')
+async def get_panels_state():
+    """Состояние предохранителей и лимитеров одновременных запросов по панелям."""
+    return panel_registry.stats()
+
+
 @api_router.post("/update_client")
 async def update_clients(
     data: UpdateClientGS,
@@ -75,23 +81,12 @@ async def update_clients(
         raise HTTPException(status_code=404, detail="Не коректная дата!")
 
     user_servers = await orm_get_user_servers(session, user.id)
-    servers = await orm_get_servers(session)
 
     new_date = datetime(int(date[0]), int(date[1]), int(date[2])+1, now.hour, now.minute, now.second, now.microsecond)
     new_unix_date = int(new_date.timestamp() * 1000)
     
-    threex_panels = []
-    for i in servers:
-        threex_panels.append(ThreeXUIServer(
-            i.id,
-            i.url,
-            i.indoub_id,
-            i.login,
-            i.password,
-            i.need_gb,
-            i.name
-        ))
-    
+    threex_panels = await get_panels(session)
+
     for server in user_servers:
         for panel in threex_panels:
             if panel.id != server.server_id:
@@ -99,12 +94,12 @@ async def update_clients(
             total_gb = 0
             if panel.need_gb:
                 try:
-                    cur = await panel.get_total_gb(server.tun_id)
+                    cur = int((await known_total_bytes(session, panel, server) or 0) // GB)
                 except Exception:
                     cur = 0
                 total_gb = max(cur, 30)
 
-            await panel.edit_client(
+            ok = await panel.edit_client(
                 uuid=server.tun_id,
                 name=user.name,
                 email=panel.name + '_' + str(server.id),
@@ -113,100 +108,53 @@ async def update_clients(
                 tg_id=user.telegram_id,
                 total_gb=total_gb,
             )
+            if ok and panel.need_gb:
+                await remember_total_gb(session, server, total_gb)
 
     await orm_update_user(
         session,
         user_id=user.id,
         data={'ips': data.devices, 'sub_end': new_date}
     )
+    subscription_cache.invalidate_user(user.id)
 
     for admin in admins:
         await bot.send_message(admin.telegram_id, f"✅ Данные изменены для пользователя {user.name}\nДата: {new_date.strftime('%d.%m.%Y')}\nКоличество устройств: {data.devices}")
 
 
-@api_router.get("/subscribtion")
-async def generate_subscription_config(user_token: str, session: AsyncSession = Depends(get_async_session)):
-    user = await orm_get_user(session, UUID(user_token))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def _build_subscription(key: tuple[str, str], user_id: UUID) -> RenderedSubscription:
+    """Сборка /api/subscribtion в своей сессии: её результат могут ждать несколько запросов."""
+    async with async_session_maker() as session:
+        version = subscription_cache.version(user_id)
+        user, user_servers = await orm_get_user_with_servers(session, user_id=user_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
 
-    today = datetime.now()
-
-    if not user.sub_end or user.sub_end < today:
-        response = Response(
-            content=(
-                f"vless://{user.id}@1.23.123.4:8452?"
-                f"type=tcp&spx=%2F&flow=#{quote('❌ Ваша подписка закончилась')}"
-            ),
-            media_type="text/plain; charset=utf-8"
-        )
-        response.headers['profile-title'] = "base64:" + base64.b64encode('⚡️ SkynetVPN'.encode('utf-8')).decode('latin-1')
-        response.headers["announce"] = "base64:" + base64.b64encode("🚀 Нажмите сюда, тут можно продлить подписку".encode('utf-8')).decode('latin-1')
-        response.headers["announce-url"] = "https://t.me/skynetaivpn_bot"
-        return response
+        try:
+            rendered, complete = await render_subscription(session, user, user_servers)
+        except SubscriptionUnavailable as e:
+            raise HTTPException(status_code=404, detail=str(e))
 
-    user_servers = await orm_get_user_servers(session, user.id)
-    if not user_servers:
-        raise HTTPException(status_code=404, detail="No servers for user")
-
-    servers = await orm_get_servers(session)
-    threex_panels = [
-        ThreeXUIServer(
-            s.id, s.url, s.indoub_id, s.login, s.password, s.need_gb
-        )
-        for s in servers
-    ]
-
-    config_lines = []
-    trafic = 0
-    # Итерируемся по серверам (отсортированы по id), а не по user_servers
-    for server in servers:
-        # Ищем user_server для этого сервера
-        user_server = None
-        for us in user_servers:
-            if us.server_id == server.id:
-                user_server = us
-                break
-
-        if not user_server:
-            continue
-
-        # Ищем панель
-        for panel in threex_panels:
-            if panel.id == server.id:
-                vless_url = await panel.get_client_vless(user_server.tun_id)
-                if panel.need_gb:
-                    trafic = await panel.client_remain_trafic(user_server.tun_id) or 0
-                if vless_url:
-                    config_lines.append(vless_url)
-                break
-
-    if not config_lines:
-        raise HTTPException(status_code=404, detail="No configs found")
-
-    response = Response(
-        content="\n".join(config_lines),
-        media_type="text/plain; charset=utf-8"
-    )
+    # неполную подписку (часть панелей не ответила) не кэшируем
+    if complete:
+        subscription_cache.put(key, user.id, rendered, version)
+    return rendered
 
-    response.headers['profile-title'] = "base64:" + base64.b64encode('⚡️ SkynetVPN'.encode('utf-8')).decode('latin-1')
-    response.headers["announce"] = "base64:" + base64.b64encode(
-        ("🚀 Нажмите сюда, чтобы перейти в нашего бота\n\n"
-         "👑 - без рекламы на YouTube\n"
-         "🎧 - YouTube можно сворачивать \n\n"
-         "Отображаемое количество трафика относиться только к обходу белых списков.").encode('utf-8')
-    ).decode('latin-1')
-    response.headers["announce-url"] = "https://t.me/skynetaivpn_bot"
-    response.headers["subscription-userinfo"] = (
-        f"expire={int(user.sub_end.timestamp())}; "
-        f"upload={trafic[0]}; download={trafic[1]}; total={trafic[2]}"
-    )
-    response.headers["X-Frame-Options"] = "SAMEORIGIN"
-    response.headers["Referrer-Policy"] = "no-referrer-when-downgrade"
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["Permissions-Policy"] = "geolocation=(), microphone=()"
-    response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
 
-    return response
+@api_router.get("/subscribtion")
+async def generate_subscription_config(
+    user_token: str,
+    if_none_match: str | None = Header(None)
+):
+    try:
+        user_id = UUID(user_token)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="User not found")
+    key = ('api', str(user_id))
 
+    # попадание в кэш отдаётся без БД и панелей, одновременные промахи собираются один раз
+    rendered = subscription_cache.get(key)
+    if rendered is None:
+        rendered = await subscription_flights.do(key, lambda: _build_subscription(key, user_id))
 
+    return subscription_response(rendered, if_none_match)
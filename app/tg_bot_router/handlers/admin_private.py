@@ -1,4 +1,6 @@
 import html
+import os
+import time
 from typing import Optional
 from uuid import uuid4
 from aiogram import Router, types, F, Bot
@@ -6,7 +8,7 @@ from aiogram.filters import Command, StateFilter
 from aiogram.filters.logic import or_f
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InputMediaPhoto, Message
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -19,7 +21,7 @@ from app.utils.days_to_month import days_to_str
 from app.setup_logger import logger
 from app.database.queries import (
     orm_add_faq,
-    orm_add_user_server,
+    orm_add_user_servers,
     orm_delete_faq,
     orm_add_server,
     orm_add_tariff,
@@ -30,7 +32,6 @@ from app.database.queries import (
     orm_get_servers,
     orm_get_tariff,
     orm_get_tariffs,
-    orm_get_user_server_by_ti,
     orm_update_server,
     orm_update_tariff,
     orm_delete_tariff,
@@ -39,7 +40,9 @@ from app.database.queries import (
     orm_delete_user_servers_by_si,
     orm_get_user_servers_by_si,
 )
-from app.utils.three_x_ui_api import ThreeXUIServer
+from app.utils.reconcile import reconcile
+from app.utils.subscription_cache import subscription_cache
+from app.utils.three_x_ui_api import ThreeXUIServer, get_panel
 
 admin_private_router = Router()
 admin_private_router.message.filter(AdminFilter())
@@ -353,6 +356,88 @@ async def add_server_need_gb(message: types.Message, state: FSMContext):
     )
 
 
+PROVISION_CHUNK_SIZE = int(os.getenv("PROVISION_CHUNK_SIZE", "300"))
+# не чаще одного обновления прогресса за столько секунд (flood control Telegram)
+PROVISION_PROGRESS_INTERVAL = float(os.getenv("PROVISION_PROGRESS_INTERVAL", "3"))
+
+
+async def _send_progress(message: types.Message, text: str, progress: types.Message | None = None):
+    """Прогресс в чат админа; ошибка Telegram (в т.ч. RetryAfter) не должна прерывать заведение клиентов."""
+    try:
+        if progress is None:
+            return await message.answer(text)
+        await progress.edit_text(text)
+    except TelegramAPIError as e:
+        logger.warning(f"Не удалось обновить прогресс: {e}")
+    return progress
+
+
+async def provision_server_clients(
+        message: types.Message,
+        session: AsyncSession,
+        threex_panel: ThreeXUIServer,
+        server_name: str
+):
+    """Заводит всех пользователей с подпиской на новый сервер: один bulk insert в БД
+    и addClient пачками по PROVISION_CHUNK_SIZE с прогрессом в чат админа."""
+    users = [user for user in await orm_get_users(session) if user.sub_end]
+    if not users:
+        return
+
+    tariffs = {}
+    if threex_panel.need_gb:
+        tariffs = {tariff.id: tariff for tariff in await orm_get_tariffs(session)}
+
+    user_servers = await orm_add_user_servers(session, [
+        {'user_id': user.id, 'server_id': threex_panel.id, 'tun_id': str(uuid4())}
+        for user in users
+    ])
+
+    users_by_id = {user.id: user for user in users}
+    clients = []
+    for user_server in user_servers:
+        user = users_by_id[user_server.user_id]
+        tariff = tariffs.get(user.tariff_id)
+        clients.append(threex_panel.make_client(
+            uuid=user_server.tun_id,
+            email=server_name + '_' + str(user_server.id),
+            limit_ip=user.ips,
+            name=user.name,
+            tg_id=str(user.telegram_id),
+            expiry_time=int(user.sub_end.timestamp() * 1000),
+            total_gb=tariff.trafic if tariff else 0
+        ))
+
+    progress = await _send_progress(message, f"⏳ Добавление клиентов на сервер: 0/{len(clients)}")
+    progress_at = time.monotonic()
+    added = 0
+    failed = 0
+    for start in range(0, len(clients), PROVISION_CHUNK_SIZE):
+        chunk = clients[start:start + PROVISION_CHUNK_SIZE]
+        try:
+            ok = await threex_panel.add_clients(chunk)
+        except Exception:
+            logger.error(f"Не удалось добавить пачку клиентов на {threex_panel.url}", exc_info=True)
+            ok = False
+
+        if ok:
+            added += len(chunk)
+        else:
+            failed += len(chunk)
+
+        if progress is None or time.monotonic() - progress_at < PROVISION_PROGRESS_INTERVAL:
+            continue
+        progress_at = time.monotonic()
+        await _send_progress(
+            message,
+            f"⏳ Добавление клиентов на сервер: {added + failed}/{len(clients)}"
+            + (f"\n❌ Ошибок: {failed}" if failed else ""),
+            progress
+        )
+
+    await _send_progress(message, f"Клиентов добавлено: {added}" + (f", с ошибкой: {failed}" if failed else ""))
+
+
 @admin_private_router.message(FSMAddServer.need_gb, F.text)
 async def add_server_password(message: types.Message, state: FSMContext, session: AsyncSession):
     if FSMAddServer.server_to_change and message.text == '.':
@@ -381,42 +466,13 @@ async def add_server_password(message: types.Message, state: FSMContext, session
             password=data['password'],
             need_gb=data['need_gb']
         )
-        users = await orm_get_users(session)
-        servers = await orm_get_servers(session)
-        threex_panel = ThreeXUIServer(
-            0,
-            data['url'],
-            data['indoub_id'],
-            data['login'],
-            data['password'],
-            data['need_gb']
-        )
         server = await orm_get_server_by_ui(session, data['url'], data['indoub_id'])
-
-        for user in users:
-            if user.sub_end:
-                tariff = None
-                if data['need_gb']:
-                    tariff = await orm_get_tariff(session, user.tariff_id)
-                uuid = uuid4()
-                await orm_add_user_server(
-                    session,
-                    user_id=user.id,
-                    server_id=server.id,
-                    tun_id=str(uuid)
-                )
-                user_server = await orm_get_user_server_by_ti(session, str(uuid))
-                await threex_panel.add_client(
-                    uuid=str(uuid),
-                    email=data['name'] + '_' + str(user_server.id),
-                    limit_ip=user.ips,
-                    name=user.name,
-                    tg_id=str(user.telegram_id),
-                    expiry_time=int(user.sub_end.timestamp() * 1000),
-                    total_gb=tariff.trafic if tariff and data['need_gb'] else 0
-                )
+        threex_panel = await get_panel(session, server.id)
+        await provision_server_clients(message, session, threex_panel, data['name'])
         await message.answer("✅ Сервер добавлен", reply_markup=admin_menu_kbrd())
 
+    # состав или параметры серверов изменились — подписки всех пользователей пересобираются
+    subscription_cache.clear()
     await state.clear()
 
 
@@ -424,23 +480,18 @@ async def add_server_password(message: types.Message, state: FSMContext, session
 async def delete_server(callback_query: types.CallbackQuery, session: AsyncSession):
     try:
         server_id = int(callback_query.data.split("_")[-1])
-        server = await orm_get_server(session, server_id)
+        threex_panel = await get_panel(session, server_id)
+        if not threex_panel:
+            raise ValueError(f"Сервер {server_id} не найден")
         users_servers = await orm_get_user_servers_by_si(session, server_id)
 
-        threex_panel = ThreeXUIServer(
-            id=0,
-            url=server.url,
-            indoub_id=server.indoub_id,
-            login=server.login,
-            password=server.password
-        )
-
         if users_servers:
             for i in users_servers:
                 await threex_panel.delete_client(i.tun_id)
 
         await orm_delete_user_servers_by_si(session, server_id)
         await orm_delete_server(session, server_id)
+        subscription_cache.clear()
         await callback_query.message.delete()
         await callback_query.message.answer(f"✅ сервер удален", reply_markup=admin_menu_kbrd())
         await callback_query.answer()
@@ -656,6 +707,22 @@ async def send_letter(
     await callback.answer()
 
 
+@admin_private_router.message(StateFilter(None), Command('reconcile'))
+async def reconcile_servers(message: types.Message, session: AsyncSession):
+    """/reconcile — сверка users_servers с клиентами панелей, /reconcile fix — с исправлением."""
+    repair = 'fix' in (message.text or '').split()[1:]
+    progress = await message.answer(f"⏳ Сверка серверов{' с исправлением' if repair else ''}...")
+
+    reports = await reconcile(session, repair=repair)
+    if repair:
+        subscription_cache.clear()
+
+    text = "\n".join(report.summary() for report in reports) or "Серверов пока нет."
+    if not repair and any(report.missing or report.mismatched for report in reports):
+        text += "\n\nДля исправления: /reconcile fix"
+    await progress.edit_text(text)
+
+
 @admin_private_router.message(StateFilter("*"), F.text == CANCEL_TEXT)
 async def cancel_by_button(message: types.Message, state: FSMContext):
     await state.clear()
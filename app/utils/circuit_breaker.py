@@ -0,0 +1,142 @@
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+from app.setup_logger import logger
+from app.utils.metrics import metrics
+
+T = TypeVar('T')
+
+CIRCUIT_OPEN = metrics.gauge(
+    'panel_circuit_open', 'Предохранитель панели разомкнут (1 — open/half_open, 0 — closed)', ('panel',)
+)
+
+
+class PanelUnavailableError(Exception):
+    """Запрос к панели не выполнен: цепь разомкнута или превышен лимит одновременных запросов."""
+
+
+class CircuitOpenError(PanelUnavailableError):
+    pass
+
+
+class PanelBusyError(PanelUnavailableError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Предохранитель + ограничитель одновременных запросов для одной панели.
+    closed    — запросы идут как обычно, считаем подряд идущие ошибки;
+    open      — после failure_threshold ошибок запросы сразу отклоняются recovery_timeout секунд;
+    half_open — пропускаем один пробный запрос: успех замыкает цепь, ошибка снова размыкает.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30,
+        max_in_flight: int = 10,
+        acquire_timeout: float = 2
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.acquire_timeout = acquire_timeout
+        self.max_in_flight = max_in_flight
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+
+        self._set_state(self.CLOSED)
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def _before_call(self) -> bool:
+        """Проверяет состояние цепи. Возвращает True, если это пробный запрос half_open."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(f"Панель {self.name} недоступна (circuit open)")
+            self._set_state(self.HALF_OPEN)
+
+        if self.state == self.HALF_OPEN:
+            if self.probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(f"Панель {self.name} недоступна (идёт проверка)")
+            self.probe_in_flight = True
+            return True
+
+        return False
+
+    def _record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"Панель {self.name} снова доступна")
+        self._set_state(self.CLOSED)
+        self.failures = 0
+
+    def _record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Панель {self.name} отключена на {self.recovery_timeout}с после {self.failures} ошибок")
+            self._set_state(self.OPEN)
+            self.opened_at = time.monotonic()
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        CIRCUIT_OPEN.set(self.name, value=0 if state == self.CLOSED else 1)
+
+    async def call(
+        self,
+        func: Callable[[], Awaitable[T]],
+        is_failure: Callable[[T], bool] = lambda result: False
+    ) -> T:
+        probe = self._before_call()
+        try:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.acquire_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise PanelBusyError(f"Панель {self.name}: превышен лимит одновременных запросов")
+            finally:
+                self.waiting -= 1
+
+            self.in_flight += 1
+            try:
+                result = await func()
+            except Exception:
+                self._record_failure()
+                raise
+            finally:
+                self.in_flight -= 1
+                self.semaphore.release()
+
+            if is_failure(result):
+                self._record_failure()
+            else:
+                self._record_success()
+            return result
+        finally:
+            if probe:
+                self.probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+        }
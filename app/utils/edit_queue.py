@@ -0,0 +1,93 @@
+import asyncio
+import os
+from collections.abc import Awaitable, Callable
+
+from app.setup_logger import logger
+
+
+class EditQueue:
+    """
+    Очередь updateClient одной панели (inbound).
+    Правки одного клиента, которые ещё не ушли в панель, сливаются в одну — побеждает последняя,
+    т.к. updateClient всегда передаёт клиента целиком. Все ожидающие получают результат
+    итогового запроса. Разные клиенты пачки отправляются конкурентно; правка, пришедшая
+    во время отправки, уходит следующей пачкой, поэтому порядок правок одного клиента сохраняется.
+    """
+
+    def __init__(self, name: str, window: float) -> None:
+        self.name = name
+        self.window = window
+        self.send: Callable[[dict], Awaitable[bool]] | None = None
+        self.pending: dict[str, tuple[dict, list[asyncio.Future]]] = {}
+        self.task: asyncio.Task | None = None
+
+        self.submitted = 0
+        self.merged = 0
+        self.sent = 0
+        self.failed = 0
+
+    def submit(self, client: dict, send: Callable[[dict], Awaitable[bool]]) -> asyncio.Future:
+        self.send = send
+        self.submitted += 1
+        future = asyncio.get_running_loop().create_future()
+
+        entry = self.pending.get(client['id'])
+        if entry:
+            self.pending[client['id']] = (client, entry[1] + [future])
+            self.merged += 1
+        else:
+            self.pending[client['id']] = (client, [future])
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self) -> None:
+        while self.pending:
+            # окно, за которое успевают прийти повторные правки тех же клиентов
+            await asyncio.sleep(self.window)
+            batch, self.pending = self.pending, {}
+
+            # в пачке uuid разные — отправляем конкурентно (число запросов к панели ограничивает breaker)
+            await asyncio.gather(*(
+                self._send_one(uuid, client, futures) for uuid, (client, futures) in batch.items()
+            ))
+
+    async def _send_one(self, uuid: str, client: dict, futures: list[asyncio.Future]) -> None:
+        try:
+            ok = await self.send(client)
+        except Exception as e:
+            logger.error(f"Ошибка изменения клиента {uuid} на {self.name}: {e}")
+            ok = False
+
+        self.sent += 1
+        if not ok:
+            self.failed += 1
+            logger.warning(f"Не применена правка клиента {uuid} на {self.name} (ожидало {len(futures)})")
+        for future in futures:
+            if not future.done():
+                future.set_result(ok)
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self.pending),
+            'submitted': self.submitted,
+            'merged': self.merged,
+            'sent': self.sent,
+            'failed': self.failed,
+        }
+
+
+class EditQueues:
+    def __init__(self) -> None:
+        self.queues: dict[tuple[str, int], EditQueue] = {}
+        self.window = float(os.getenv("EDIT_COALESCE_WINDOW", "0.05"))
+
+    def get(self, key: tuple[str, int], name: str) -> EditQueue:
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = EditQueue(name, self.window)
+        return queue
+
+
+edit_queues = EditQueues()
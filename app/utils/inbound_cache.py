@@ -0,0 +1,267 @@
+import asyncio
+import os
+import time
+from collections.abc import Awaitable, Callable
+
+from app.setup_logger import logger
+from app.utils import json_scan
+from app.utils.vless_template import VlessTemplate
+
+
+class InboundSnapshot:
+    """
+    Разобранный inbound 3x-ui: клиенты проиндексированы по uuid,
+    трафик из clientStats — по uuid в виде (up, down, total) в байтах.
+    Индекс строится лениво (build) и только там, где нужен весь список клиентов
+    (сверка, сброс трафика, поллер): разбор держит GIL, и на 100k клиентов это сотни мс
+    простоя event loop. Отдельный клиент и его трафик ищутся сканированием сырого settings,
+    а локальные правки до разбора копятся в небольшом оверлее поверх него.
+    """
+
+    def __init__(
+        self,
+        inbound: dict,
+        settings_raw: str,
+        stream_settings: dict,
+        template: VlessTemplate | None = None
+    ) -> None:
+        self.port = inbound.get('port')
+        self.stream_settings = stream_settings
+        self.template = template
+        self.fetched_at = time.monotonic()
+
+        self.raw_settings: str | None = settings_raw
+        self.client_stats: list[dict] = inbound.get('clientStats') or []
+        self._clients: dict[str, dict] | None = None
+        self._stats_by_email: dict[str, dict] | None = None
+        # правки до разбора: uuid -> клиент (None — удалён), email -> (up, down, total)
+        self._client_overlay: dict[str, dict | None] = {}
+        self._traffic_overlay: dict[str, tuple[int, int, int]] = {}
+
+    def build(self) -> None:
+        """Полный разбор settings и индексы (синхронно, на всё время разбора занимает event loop)."""
+        if self._clients is not None:
+            return
+        settings = json_scan.loads(self.raw_settings or '{}')
+        clients = {c.get('id'): c for c in settings.pop('clients', None) or []}
+        # settings без списка клиентов (encryption, decryption и т.п.)
+        self._settings = settings
+        self._emails: dict[str, str] = {c.get('email'): uuid for uuid, c in clients.items()}
+        self._traffics: dict[str, tuple[int, int, int]] = {}
+        for stat in self.client_stats:
+            uuid = self._emails.get(stat.get('email'))
+            if uuid:
+                self._traffics[uuid] = (stat.get('up') or 0, stat.get('down') or 0, stat.get('total') or 0)
+        self._clients = clients
+        self.raw_settings = None
+        self.client_stats = []
+        self._stats_by_email = None
+
+        client_overlay, traffic_overlay = self._client_overlay, self._traffic_overlay
+        self._client_overlay, self._traffic_overlay = {}, {}
+        for uuid, client in client_overlay.items():
+            if client is None:
+                self.remove_client(uuid)
+            else:
+                self.upsert_client(client)
+        for email, traf in traffic_overlay.items():
+            uuid = self._emails.get(email)
+            if uuid:
+                self._traffics[uuid] = traf
+
+    @property
+    def clients(self) -> dict[str, dict]:
+        self.build()
+        return self._clients
+
+    @property
+    def settings(self) -> dict:
+        self.build()
+        return self._settings
+
+    @property
+    def emails(self) -> dict[str, str]:
+        self.build()
+        return self._emails
+
+    @property
+    def traffics(self) -> dict[str, tuple[int, int, int]]:
+        self.build()
+        return self._traffics
+
+    def find_client(self, uuid: str) -> dict | None:
+        """Клиент по uuid: из индекса, а пока он не построен — сканированием сырого settings."""
+        if self._clients is not None:
+            return self._clients.get(uuid)
+        if uuid in self._client_overlay:
+            return self._client_overlay[uuid]
+        raw = self.raw_settings
+        if raw is None:
+            return self.clients.get(uuid)
+        return json_scan.find_client(raw, uuid)
+
+    def traffic(self, uuid: str) -> tuple[int, int, int] | None:
+        """Трафик одного клиента без полного разбора: клиент — сканированием, статистика — по email."""
+        if self._clients is not None:
+            return self._traffics.get(uuid)
+        client = self.find_client(uuid)
+        if client is None:
+            return None
+        return self._email_traffic(client.get('email'))
+
+    def _email_traffic(self, email: str) -> tuple[int, int, int] | None:
+        if email in self._traffic_overlay:
+            return self._traffic_overlay[email]
+        if self._stats_by_email is None:
+            # clientStats уже разобран вместе с ответом панели — индекс по email дешёвый
+            self._stats_by_email = {stat.get('email'): stat for stat in self.client_stats}
+        stat = self._stats_by_email.get(email)
+        if stat is None:
+            return None
+        return stat.get('up') or 0, stat.get('down') or 0, stat.get('total') or 0
+
+    def vless(self, uuid: str) -> str | None:
+        """vless-ссылка клиента по скомпилированному шаблону, без обращения к панели."""
+        client = self.find_client(uuid)
+        if client is None or self.template is None:
+            return None
+        return self.template.render_client(client)
+
+    # мутации: до разбора — в оверлей, после — прямо в индексы
+    def upsert_client(self, client: dict) -> None:
+        uuid = client['id']
+        if self._clients is None:
+            old = self.find_client(uuid)
+            up, down, _ = (self._email_traffic(old.get('email')) if old else None) or (0, 0, 0)
+            self._client_overlay[uuid] = client
+            self._traffic_overlay[client.get('email')] = (up, down, client.get('totalGB') or 0)
+            return
+        old = self.clients.get(uuid)
+        if old:
+            self.emails.pop(old.get('email'), None)
+        self.clients[uuid] = client
+        self.emails[client.get('email')] = uuid
+        up, down, _ = self.traffics.get(uuid, (0, 0, 0))
+        self.traffics[uuid] = (up, down, client.get('totalGB') or 0)
+
+    def remove_client(self, uuid: str) -> None:
+        if self._clients is None:
+            self._client_overlay[uuid] = None
+            return
+        client = self.clients.pop(uuid, None)
+        if client:
+            self.emails.pop(client.get('email'), None)
+        self.traffics.pop(uuid, None)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+class InboundCache:
+    """
+    Процессный кэш снапшотов inbound по ключу (url панели, id inbound).
+    - свежий снапшот (моложе ttl) отдаётся как есть;
+    - устаревший (моложе max_stale) отдаётся сразу, а в фоне запускается обновление;
+    - каждая локальная мутация клиентов увеличивает версию ключа, и загрузка,
+      начатая до мутации, не перетирает снапшот.
+    """
+
+    def __init__(self) -> None:
+        self.snapshots: dict[tuple[str, int], InboundSnapshot] = {}
+        self.versions: dict[tuple[str, int], int] = {}
+        self.tasks: dict[tuple[str, int], asyncio.Task] = {}
+        # (ключ, uuid) -> когда свежая загрузка подтвердила, что клиента нет
+        self.misses: dict[tuple[tuple[str, int], str], float] = {}
+        self.ttl = float(os.getenv("INBOUND_CACHE_TTL", "60"))
+        self.max_stale = float(os.getenv("INBOUND_CACHE_MAX_STALE", "600"))
+        self.miss_ttl = float(os.getenv("INBOUND_MISS_TTL", "30"))
+
+    def version(self, key: tuple[str, int]) -> int:
+        return self.versions.get(key, 0)
+
+    def get(self, key: tuple[str, int]) -> InboundSnapshot | None:
+        snapshot = self.snapshots.get(key)
+        if snapshot and snapshot.age > self.max_stale:
+            self.snapshots.pop(key, None)
+            return None
+        return snapshot
+
+    def is_fresh(self, snapshot: InboundSnapshot) -> bool:
+        return snapshot.age <= self.ttl
+
+    def put(self, key: tuple[str, int], snapshot: InboundSnapshot, version: int) -> bool:
+        """Сохраняет снапшот, если с момента начала загрузки не было мутаций."""
+        if self.version(key) != version:
+            return False
+        self.snapshots[key] = snapshot
+        return True
+
+    def invalidate(self, key: tuple[str, int]) -> None:
+        self.versions[key] = self.version(key) + 1
+        self.snapshots.pop(key, None)
+
+    def missed_recently(self, key: tuple[str, int], uuid: str) -> bool:
+        """Клиента недавно не нашли и в свежем inbound — повторно панель не перечитываем."""
+        missed_at = self.misses.get((key, uuid))
+        if missed_at is None:
+            return False
+        if time.monotonic() - missed_at > self.miss_ttl:
+            self.misses.pop((key, uuid), None)
+            return False
+        return True
+
+    def mark_missing(self, key: tuple[str, int], uuid: str) -> None:
+        now = time.monotonic()
+        if len(self.misses) >= 10000:
+            self.misses = {k: t for k, t in self.misses.items() if now - t <= self.miss_ttl}
+        self.misses[(key, uuid)] = now
+
+    def _mutate(self, key: tuple[str, int]) -> InboundSnapshot | None:
+        """Снапшот для локальной правки; неразобранный правится через оверлей, без разбора."""
+        self.versions[key] = self.version(key) + 1
+        return self.snapshots.get(key)
+
+    def upsert_client(self, key: tuple[str, int], client: dict) -> None:
+        self.misses.pop((key, client['id']), None)
+        snapshot = self._mutate(key)
+        if snapshot:
+            snapshot.upsert_client(client)
+
+    def remove_client(self, key: tuple[str, int], uuid: str) -> None:
+        snapshot = self._mutate(key)
+        if snapshot:
+            snapshot.remove_client(uuid)
+
+    async def fetch(
+        self,
+        key: tuple[str, int],
+        loader: Callable[[], Awaitable[InboundSnapshot | None]]
+    ) -> InboundSnapshot | None:
+        """Загрузка с объединением: одновременные промахи ждут один и тот же запрос."""
+        task = self.tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(loader())
+            self.tasks[key] = task
+            task.add_done_callback(lambda t: self._task_done(key, t))
+        return await asyncio.shield(task)
+
+    def refresh_in_background(
+        self,
+        key: tuple[str, int],
+        loader: Callable[[], Awaitable[InboundSnapshot | None]]
+    ) -> None:
+        if key in self.tasks:
+            return
+        task = asyncio.create_task(loader())
+        self.tasks[key] = task
+        task.add_done_callback(lambda t: self._task_done(key, t))
+
+    def _task_done(self, key: tuple[str, int], task: asyncio.Task) -> None:
+        if self.tasks.get(key) is task:
+            self.tasks.pop(key, None)
+        if not task.cancelled() and task.exception():
+            logger.warning(f"Не удалось обновить inbound {key}: {task.exception()}")
+
+
+inbound_cache = InboundCache()
@@ -0,0 +1,88 @@
+import json
+import os
+import re
+from collections.abc import Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# быстрый парсер, если установлен orjson (JSON_BACKEND=json — принудительно стандартный)
+JSON_BACKEND = 'orjson' if orjson is not None and os.getenv("JSON_BACKEND", "orjson") == "orjson" else 'json'
+loads = orjson.loads if JSON_BACKEND == 'orjson' else json.loads
+
+_decoder = json.JSONDecoder()
+_separators = re.compile(r'[\s,]*')
+
+
+def iter_array(raw: str, key: str) -> Iterator:
+    """
+    Элементы массива "key" из сырого JSON по одному, без разбора всего документа.
+    Ключ ищется по первому вхождению — годится для массивов верхнего уровня вроде settings.clients.
+    """
+    start = raw.find(f'"{key}"')
+    if start == -1:
+        return
+    pos = raw.find('[', start)
+    if pos == -1:
+        return
+
+    pos += 1
+    while True:
+        pos = _separators.match(raw, pos).end()
+        if pos >= len(raw) or raw[pos] == ']':
+            return
+        item, pos = _decoder.raw_decode(raw, pos)
+        yield item
+
+
+def find_client(raw: str, uuid: str) -> dict | None:
+    """
+    Клиент с id == uuid из сырого settings inbound. Разбирается только объект вокруг
+    найденного uuid; если он не похож на клиента — перебор clients до первого совпадения.
+    """
+    needle = f'"{uuid}"'
+    pos = raw.find(needle)
+    while pos != -1:
+        start = raw.rfind('{', 0, pos)
+        try:
+            obj = _decoder.raw_decode(raw, start)[0] if start != -1 else None
+        except ValueError:
+            obj = None
+
+        if not isinstance(obj, dict) or 'id' not in obj:
+            # '{' оказалась не началом клиента (вложенный объект, скобка в строке)
+            break
+        if obj['id'] == uuid:
+            return obj
+        # uuid встретился в другом поле клиента — ищем дальше
+        pos = raw.find(needle, pos + len(needle))
+    else:
+        return None
+
+    for client in iter_array(raw, 'clients'):
+        if isinstance(client, dict) and client.get('id') == uuid:
+            return client
+    return None
+
+
+def find_value(raw: str, key: str, default=None):
+    """
+    Значение ключа "key" без разбора всего документа. Совпадения-значения (например,
+    comment клиента с тем же текстом) пропускаются: строка считается ключом, только если за ней
+    идёт ':'. Годится для ключей верхнего уровня, которых нет во вложенных объектах
+    (у клиентов 3x-ui нет encryption/decryption).
+    """
+    needle = f'"{key}"'
+    pos = raw.find(needle)
+    while pos != -1:
+        colon = _separators.match(raw, pos + len(needle)).end()
+        if raw.startswith(':', colon):
+            try:
+                return _decoder.raw_decode(raw, _separators.match(raw, colon + 1).end())[0]
+            except ValueError:
+                return default
+        pos = raw.find(needle, pos + len(needle))
+    return default
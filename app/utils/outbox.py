@@ -0,0 +1,196 @@
+import asyncio
+import os
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.engine import async_session_maker
+from app.database.models import PanelOperation
+from app.database.queries import (
+    orm_claim_panel_operation,
+    orm_finish_panel_operation,
+    orm_release_panel_operation,
+    orm_requeue_stale_operations,
+)
+from app.setup_logger import logger
+
+
+class OperationFailed(Exception):
+    """Операция не выполнена (панель ответила ошибкой) — будет повтор с backoff."""
+
+
+class OperationDeferred(Exception):
+    """Операцию рано выполнять (например, ждём соседние операции) — повтор без траты попытки."""
+
+
+Handler = Callable[[AsyncSession, PanelOperation], Awaitable[dict | None]]
+
+
+class Outbox:
+    """
+    Пул воркеров, разбирающий таблицу panel_operations.
+    Обработчик операции возвращает result (сохраняется в строке) или бросает исключение;
+    неудачи повторяются с экспоненциальной задержкой до OUTBOX_MAX_ATTEMPTS.
+    """
+
+    def __init__(self) -> None:
+        self.handlers: dict[str, Handler] = {}
+        self.workers = int(os.getenv("OUTBOX_WORKERS", "4"))
+        self.poll_interval = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))
+        self.max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+        self.backoff_base = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))
+        self.backoff_max = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+        self.defer_delay = float(os.getenv("OUTBOX_DEFER_DELAY", "1"))
+        self.stale_after = float(os.getenv("OUTBOX_STALE_AFTER", "300"))
+        self.requeue_interval = float(os.getenv("OUTBOX_REQUEUE_INTERVAL", "60"))
+        self.stop_timeout = float(os.getenv("OUTBOX_STOP_TIMEOUT", "10"))
+
+        self.tasks: list[asyncio.Task] = []
+        self.dispatching: set[asyncio.Task] = set()
+        self.stopping = False
+
+    def register(self, kind: str, handler: Handler) -> None:
+        self.handlers[kind] = handler
+
+    def dispatch(self, *groups: list[int]) -> asyncio.Task | None:
+        """
+        Выполняет только что поставленные операции сразу, не дожидаясь воркеров:
+        группы по очереди, операции внутри группы — конкурентно. Неудачные остаются
+        в таблице и повторяются воркерами как обычно. После stop() ничего не запускает —
+        операции уже в таблице и выполнятся после рестарта.
+        """
+        if self.stopping:
+            return None
+        task = asyncio.create_task(self._dispatch(groups))
+        self.dispatching.add(task)
+        task.add_done_callback(self.dispatching.discard)
+        return task
+
+    async def _dispatch(self, groups: tuple[list[int], ...]) -> None:
+        for group in groups:
+            results = await asyncio.gather(*(self._run_claimed(op_id) for op_id in group), return_exceptions=True)
+            for op_id, result in zip(group, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Ошибка выполнения операции id={op_id}: {result}")
+
+    async def _run_claimed(self, operation_id: int) -> None:
+        async with async_session_maker() as session:
+            # операцию мог уже забрать воркер
+            operation = await orm_claim_panel_operation(session, operation_id)
+            if operation is not None:
+                await self._execute(session, operation)
+
+    def backoff(self, attempts: int) -> float:
+        return min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+
+    async def requeue_stale(self) -> int:
+        async with async_session_maker() as session:
+            requeued = await orm_requeue_stale_operations(session, self.stale_after)
+        if requeued:
+            logger.warning(f"Возвращено в очередь зависших операций: {requeued}")
+        return requeued
+
+    async def start(self) -> None:
+        self.stopping = False
+        await self.requeue_stale()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self._requeue_loop()))
+
+    async def _requeue_loop(self) -> None:
+        """Операции, захваченные упавшим процессом (или потерявшие соединение), не ждут рестарта."""
+        while True:
+            await asyncio.sleep(self.requeue_interval)
+            try:
+                await self.requeue_stale()
+            except Exception as e:
+                logger.error(f"Ошибка возврата зависших операций outbox: {e}")
+
+    async def stop(self) -> None:
+        """
+        Воркеры останавливаются сразу, начатым оплатам даётся OUTBOX_STOP_TIMEOUT секунд
+        на завершение. Прерванные операции возвращаются в pending в _execute; операцию,
+        прерванную между захватом и выполнением, вернёт requeue_stale.
+        """
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        if self.dispatching:
+            _, pending = await asyncio.wait(self.dispatching, timeout=self.stop_timeout)
+            if pending:
+                logger.warning(f"Outbox остановлен, прервано выполнение оплат: {len(pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                worked = await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка воркера outbox: {e}")
+                worked = False
+
+            if not worked:
+                await asyncio.sleep(self.poll_interval)
+
+    async def run_once(self) -> bool:
+        """Выполняет одну операцию. False — выполнять нечего."""
+        async with async_session_maker() as session:
+            operation = await orm_claim_panel_operation(session)
+            if operation is None:
+                return False
+            await self._execute(session, operation)
+            return True
+
+    async def _execute(self, session: AsyncSession, operation: PanelOperation) -> None:
+        handler = self.handlers.get(operation.kind)
+        if handler is None:
+            logger.error(f"Нет обработчика операции {operation.kind} (id={operation.id})")
+            await orm_finish_panel_operation(session, operation, 'failed', error='unknown kind')
+            return
+
+        operation_id = operation.id
+        try:
+            result = await handler(session, operation)
+        except asyncio.CancelledError:
+            # остановка процесса посреди операции — сразу обратно в очередь, а не ждать stale_after
+            try:
+                await session.rollback()
+                await orm_release_panel_operation(session, operation_id)
+            except Exception as e:
+                logger.error(f"Не удалось вернуть в очередь операцию id={operation_id}: {e}")
+            raise
+        except OperationDeferred as e:
+            await orm_finish_panel_operation(
+                session, operation, 'pending', error=str(e) or None,
+                next_attempt_at=datetime.now() + timedelta(seconds=self.defer_delay)
+            )
+            return
+        except Exception as e:
+            # ошибка БД в обработчике оставляет транзакцию прерванной — без отката статус не записать
+            error = f"{type(e).__name__}: {e}"
+            await session.rollback()
+            await session.refresh(operation)
+            operation.attempts += 1
+            if operation.attempts >= self.max_attempts:
+                logger.error(f"Операция {operation.kind} id={operation.id} не выполнена за {operation.attempts} попыток: {error}")
+                await orm_finish_panel_operation(session, operation, 'failed', error=error)
+            else:
+                delay = self.backoff(operation.attempts)
+                logger.warning(f"Операция {operation.kind} id={operation.id} попытка {operation.attempts}: {error}, повтор через {delay:.0f}с")
+                await orm_finish_panel_operation(
+                    session, operation, 'pending', error=error,
+                    next_attempt_at=datetime.now() + timedelta(seconds=delay)
+                )
+            return
+
+        if result is not None:
+            operation.result = result
+        await orm_finish_panel_operation(session, operation, 'done')
+
+
+outbox = Outbox()
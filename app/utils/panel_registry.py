@@ -0,0 +1,101 @@
+import asyncio
+import os
+from typing import Any
+from urllib.parse import urlsplit
+
+from httpx import AsyncClient, Limits, Timeout
+
+from app.setup_logger import logger
+from app.utils.circuit_breaker import CircuitBreaker
+
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+
+class PanelRegistry:
+    """
+    Процессный реестр 3x-ui панелей.
+    Держит по одному долгоживущему httpx-клиенту (keep-alive, HTTP/2 если установлен h2)
+    на каждый url панели, чтобы не платить TCP + TLS handshake за каждый запрос,
+    и по одному предохранителю с лимитом одновременных запросов.
+    Также хранит загруженные из БД объекты панелей (см. three_x_ui_api.get_panels),
+    которые сбрасываются только при добавлении/изменении/удалении сервера.
+    """
+
+    def __init__(self) -> None:
+        self.clients: dict[str, AsyncClient] = {}
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.panels: dict[int, Any] | None = None
+        self.panels_version = 0
+        self.panels_lock = asyncio.Lock()
+        self.max_connections = int(os.getenv("PANEL_MAX_CONNECTIONS", "20"))
+        self.keepalive_expiry = float(os.getenv("PANEL_KEEPALIVE_EXPIRY", "60"))
+        self.connect_timeout = float(os.getenv("PANEL_CONNECT_TIMEOUT", "3"))
+        self.read_timeout = float(os.getenv("PANEL_READ_TIMEOUT", "10"))
+        self.failure_threshold = int(os.getenv("PANEL_FAILURE_THRESHOLD", "5"))
+        self.recovery_timeout = float(os.getenv("PANEL_RECOVERY_TIMEOUT", "30"))
+        self.max_in_flight = int(os.getenv("PANEL_MAX_IN_FLIGHT", "10"))
+        self.acquire_timeout = float(os.getenv("PANEL_ACQUIRE_TIMEOUT", "2"))
+
+    def _make_client(self) -> AsyncClient:
+        return AsyncClient(
+            http2=HTTP2_ENABLED,
+            timeout=Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+
+    def get_client(self, url: str) -> AsyncClient:
+        """Пуловый клиент панели. Создаётся лениво, если панель не была открыта в lifespan."""
+        client = self.clients.get(url)
+        if client is None or client.is_closed:
+            client = self._make_client()
+            self.clients[url] = client
+        return client
+
+    def get_breaker(self, url: str) -> CircuitBreaker:
+        breaker = self.breakers.get(url)
+        if breaker is None:
+            breaker = self.breakers[url] = CircuitBreaker(
+                name=urlsplit(url).netloc,
+                failure_threshold=self.failure_threshold,
+                recovery_timeout=self.recovery_timeout,
+                max_in_flight=self.max_in_flight,
+                acquire_timeout=self.acquire_timeout,
+            )
+        return breaker
+
+    def invalidate(self) -> None:
+        """Список серверов изменился — панели будут перечитаны из БД при следующем обращении."""
+        self.panels = None
+        self.panels_version += 1
+
+    def stats(self) -> list[dict]:
+        """Состояние предохранителей и лимитеров по панелям (без секретного пути панели)."""
+        return [
+            {'panel': breaker.name, **breaker.stats()}
+            for breaker in self.breakers.values()
+        ]
+
+    async def open(self, urls: list[str]) -> None:
+        for url in urls:
+            self.get_client(url)
+        logger.info(f"Открыты клиенты панелей: {len(self.clients)} (http2={HTTP2_ENABLED})")
+
+    async def close(self) -> None:
+        for url, client in self.clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f"Не удалось закрыть клиент панели {url}: {e}")
+        self.clients.clear()
+        logger.info("Клиенты панелей закрыты")
+
+
+panel_registry = PanelRegistry()
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import time
+
+from httpx import Cookies
+
+
+class PanelSession:
+    def __init__(self, cookie_header: str, expires_at: float) -> None:
+        self.cookie_header = cookie_header
+        self.expires_at = expires_at
+
+
+class PanelSessionCache:
+    """
+    Общий для всех ThreeXUIServer кэш сессионных cookie 3x-ui.
+    Ключ — (url панели, логин). Хранит срок жизни cookie и по одному lock на панель,
+    чтобы одновременно шёл только один /login.
+    """
+
+    def __init__(self) -> None:
+        self.sessions: dict[tuple[str, str], PanelSession] = {}
+        self.locks: dict[tuple[str, str], asyncio.Lock] = {}
+        # если панель не прислала expires/max-age — считаем сессию живой столько секунд
+        self.default_ttl = int(os.getenv("PANEL_SESSION_TTL", "3000"))
+        # запас, чтобы не отправить cookie, которая истечёт по дороге
+        self.expiry_margin = 30
+
+    def get(self, url: str, login: str) -> PanelSession | None:
+        session = self.sessions.get((url, login))
+        if session is None:
+            return None
+        if session.expires_at <= time.monotonic():
+            self.sessions.pop((url, login), None)
+            return None
+        return session
+
+    def set(self, url: str, login: str, cookies: Cookies) -> PanelSession | None:
+        header = "; ".join(f"{c.name}={c.value}" for c in cookies.jar)
+        if not header:
+            return None
+
+        ttl = self.default_ttl
+        now = time.time()
+        for cookie in cookies.jar:
+            if cookie.expires:
+                ttl = min(ttl, cookie.expires - now)
+
+        session = PanelSession(header, time.monotonic() + ttl - self.expiry_margin)
+        self.sessions[(url, login)] = session
+        return session
+
+    def invalidate(self, url: str, login: str, session: PanelSession | None = None) -> None:
+        """Сбрасывает сессию. Если передана session — только если в кэше всё ещё она."""
+        current = self.sessions.get((url, login))
+        if session is None or current is session:
+            self.sessions.pop((url, login), None)
+
+    def lock(self, url: str, login: str) -> asyncio.Lock:
+        lock = self.locks.get((url, login))
+        if lock is None:
+            lock = self.locks[(url, login)] = asyncio.Lock()
+        return lock
+
+
+panel_sessions = PanelSessionCache()
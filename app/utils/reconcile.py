@@ -0,0 +1,146 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.queries import orm_get_server_user_rows
+from app.setup_logger import logger
+from app.utils.three_x_ui_api import ThreeXUIServer, get_panels
+
+
+GB = 1073741824
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "300"))
+# допустимое расхождение expiryTime, мс
+EXPIRY_TOLERANCE = 1000
+
+
+@dataclass
+class ServerReport:
+    server_id: int
+    name: str
+    rows: int = 0
+    clients: int = 0
+    # uuid записей users_servers активных пользователей, которых нет в inbound
+    missing: list[str] = field(default_factory=list)
+    # uuid клиентов inbound без записи в users_servers этого сервера
+    orphaned: list[str] = field(default_factory=list)
+    # uuid клиентов, у которых expiryTime / limitIp расходятся с БД
+    mismatched: list[str] = field(default_factory=list)
+    added: int = 0
+    fixed: int = 0
+    failed: int = 0
+    error: str | None = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not (self.error or self.missing or self.orphaned or self.mismatched)
+
+    def summary(self) -> str:
+        if self.error:
+            return f"❌ {self.name}: {self.error}"
+        line = (
+            f"{'✅' if self.ok else '⚠️'} {self.name}: записей {self.rows}, клиентов {self.clients}, "
+            f"нет в панели {len(self.missing)}, лишних {len(self.orphaned)}, расхождений {len(self.mismatched)}"
+        )
+        if self.added or self.fixed or self.failed:
+            line += f"\n   исправлено: добавлено {self.added}, изменено {self.fixed}, ошибок {self.failed}"
+        return line
+
+
+def _expected(user) -> tuple[int, int]:
+    expiry = int(user.sub_end.timestamp() * 1000) if user.sub_end else 0
+    return expiry, user.ips
+
+
+async def reconcile_panel(session: AsyncSession, panel: ThreeXUIServer, repair: bool = False) -> ServerReport:
+    """
+    Сверка одного сервера: inbound читается одним запросом, записи users_servers с пользователями —
+    одним запросом, сравнение в памяти. repair=True дозаводит отсутствующих клиентов и
+    выправляет expiryTime / limitIp пачками; лишних клиентов только показывает.
+    """
+    started = time.perf_counter()
+    report = ServerReport(panel.id, panel.name)
+
+    snapshot = await panel.get_inbound(force=True)
+    if snapshot is None:
+        report.error = "панель недоступна"
+        return report
+
+    rows = await orm_get_server_user_rows(session, panel.id)
+    report.rows = len(rows)
+    report.clients = len(snapshot.clients)
+
+    to_add = []
+    to_fix = []
+    tun_ids = set()
+    for user_server, user in rows:
+        tun_ids.add(user_server.tun_id)
+        client = snapshot.clients.get(user_server.tun_id)
+        expiry, limit_ip = _expected(user)
+
+        if client is None:
+            if user.sub_end:
+                report.missing.append(user_server.tun_id)
+                to_add.append(panel.make_client(
+                    uuid=user_server.tun_id,
+                    email=f"{panel.name}_{user_server.id}",
+                    limit_ip=limit_ip,
+                    expiry_time=expiry,
+                    tg_id=str(user.telegram_id),
+                    name=user.name,
+                    total_gb=30 if panel.need_gb else 0
+                ))
+            continue
+
+        if abs((client.get('expiryTime') or 0) - expiry) > EXPIRY_TOLERANCE or client.get('limitIp') != limit_ip:
+            report.mismatched.append(user_server.tun_id)
+            to_fix.append((client, user, expiry, limit_ip))
+
+    report.orphaned = [uuid for uuid in snapshot.clients if uuid not in tun_ids]
+
+    if repair:
+        for start in range(0, len(to_add), RECONCILE_BATCH_SIZE):
+            chunk = to_add[start:start + RECONCILE_BATCH_SIZE]
+            if await panel.add_clients(chunk):
+                report.added += len(chunk)
+            else:
+                report.failed += len(chunk)
+
+        for start in range(0, len(to_fix), RECONCILE_BATCH_SIZE):
+            results = await asyncio.gather(*(
+                panel.edit_client(
+                    uuid=client['id'],
+                    name=client.get('comment') or user.name,
+                    email=client['email'],
+                    limit_ip=limit_ip,
+                    expiry_time=expiry,
+                    tg_id=str(client.get('tgId') or user.telegram_id),
+                    # текущий лимит трафика не трогаем
+                    total_gb=int((client.get('totalGB') or 0) // GB),
+                )
+                for client, user, expiry, limit_ip in to_fix[start:start + RECONCILE_BATCH_SIZE]
+            ), return_exceptions=True)
+            for result in results:
+                if result is True:
+                    report.fixed += 1
+                else:
+                    report.failed += 1
+
+    report.elapsed = time.perf_counter() - started
+    logger.info(f"Сверка {panel.name}: {report.summary()} за {report.elapsed:.2f}с")
+    return report
+
+
+async def reconcile(session: AsyncSession, repair: bool = False) -> list[ServerReport]:
+    """Сверка всех серверов. Панели опрашиваются по очереди: на каждую — один inbounds/get."""
+    reports = []
+    for panel in await get_panels(session):
+        try:
+            reports.append(await reconcile_panel(session, panel, repair=repair))
+        except Exception as e:
+            logger.error(f"Ошибка сверки сервера {panel.name}: {e}")
+            reports.append(ServerReport(panel.id, panel.name, error=str(e)))
+    return reports
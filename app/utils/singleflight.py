@@ -0,0 +1,44 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+
+from app.utils.metrics import metrics
+
+
+SINGLEFLIGHT_CALLS = metrics.counter(
+    "singleflight_calls_total",
+    "Вызовы SingleFlight: leader — запустил сборку, shared — дождался чужой",
+    ("name", "outcome")
+)
+
+
+def _retrieve(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых запросов: первый по ключу запускает сборку отдельной задачей,
+    остальные, пришедшие до её окончания, ждут тот же результат (или то же исключение).
+    Отмена одного ожидающего сборку не прерывает.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, build: Callable[[], Awaitable]):
+        task = self.calls.get(key)
+        if task is None:
+            SINGLEFLIGHT_CALLS.inc(self.name, 'leader')
+            task = asyncio.create_task(build())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            SINGLEFLIGHT_CALLS.inc(self.name, 'shared')
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        _retrieve(task)
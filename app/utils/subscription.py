@@ -0,0 +1,300 @@
+import asyncio
+import base64
+import os
+import time
+from collections.abc import Coroutine
+from datetime import datetime
+from typing import Any
+from urllib.parse import quote, urlsplit
+
+from fastapi import Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.queries import orm_get_user_with_servers
+from app.setup_logger import logger
+from app.utils.circuit_breaker import PanelUnavailableError
+from app.utils.inbound_cache import inbound_cache
+from app.utils.metrics import metrics
+from app.utils.singleflight import SingleFlight
+from app.utils.subscription_cache import RenderedSubscription, subscription_cache
+from app.utils.three_x_ui_api import ThreeXUIServer, get_panels
+
+
+# общий бюджет времени на опрос всех панелей при генерации подписки, секунды
+SUBSCRIPTION_DEADLINE = float(os.getenv("SUBSCRIPTION_DEADLINE", "3"))
+# сколько клиент может не перезапрашивать подписку (Cache-Control max-age), секунды
+SUBSCRIPTION_MAX_AGE = int(os.getenv("SUBSCRIPTION_MAX_AGE", "300"))
+# сколько ждать панель, если есть сохранённый конфиг, секунды
+SUBSCRIPTION_STALE_WAIT = float(os.getenv("SUBSCRIPTION_STALE_WAIT", "0.5"))
+
+STALE_SERVED = metrics.counter(
+    'subscription_stale_configs_total', 'Конфиги, отданные из сохранённых из-за недоступной панели', ('panel',)
+)
+STALE_AGE = metrics.histogram(
+    'subscription_stale_config_age_seconds', 'Возраст отданного сохранённого конфига', ('panel',),
+    buckets=(60, 300, 900, 3600, 6 * 3600, 24 * 3600, 3 * 24 * 3600, 7 * 24 * 3600)
+)
+
+# одновременные запросы подписки одного токена собираются один раз (ключ — как в subscription_cache)
+subscription_flights = SingleFlight('subscription')
+
+
+async def gather_with_deadline(coros: list[Coroutine], timeout: float) -> list[tuple[bool, Any]]:
+    """
+    Запускает корутины конкурентно и ждёт не дольше timeout.
+    Возвращает [(успела, результат)] в исходном порядке; не успевшие отменяются,
+    упавшие считаются не успевшими.
+    """
+    tasks = [asyncio.create_task(coro) for coro in coros]
+    if not tasks:
+        return []
+
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+    results = []
+    for task in tasks:
+        if task in done and task.exception() is None:
+            results.append((True, task.result()))
+        else:
+            if task in done:
+                logger.error("Ошибка при опросе панели", exc_info=task.exception())
+            results.append((False, None))
+    return results
+
+
+class LastGoodConfigs:
+    """
+    Последняя удачная vless-строка и трафик по (сервер, tun_id).
+    Отдаётся, когда панель не ответила или ответила ошибкой, пока в фоне идёт обновление.
+    """
+
+    def __init__(self) -> None:
+        self.entries: dict[tuple[int, str], tuple[str, tuple | None, float]] = {}
+        self.max_age = float(os.getenv("SUBSCRIPTION_STALE_MAX_AGE", "604800"))
+
+    def get(self, key: tuple[int, str]) -> tuple[str, tuple | None, float] | None:
+        """(vless, трафик, возраст в секундах) или None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        vless_url, trafic, saved_at = entry
+        age = time.monotonic() - saved_at
+        if age > self.max_age:
+            self.entries.pop(key, None)
+            return None
+        return vless_url, trafic, age
+
+    def put(self, key: tuple[int, str], vless_url: str, trafic: tuple | None) -> None:
+        self.entries[key] = (vless_url, trafic, time.monotonic())
+
+    def drop(self, key: tuple[int, str]) -> None:
+        self.entries.pop(key, None)
+
+
+last_good_configs = LastGoodConfigs()
+
+
+async def _panel_config(panel: ThreeXUIServer, tun_id: str, known_trafic: tuple | None = None):
+    """
+    (vless, трафик) с панели; PanelUnavailableError, если inbound получить не удалось.
+    known_trafic — трафик из traffic_snapshots; без него трафик читается с панели.
+    """
+    key = (panel.id, tun_id)
+    vless_url = await panel.get_client_vless(tun_id)
+    if not vless_url and inbound_cache.get(panel.inbound_key) is None:
+        raise PanelUnavailableError(f"Панель {panel.id} недоступна")
+
+    trafic = None
+    if panel.need_gb:
+        trafic = known_trafic or await panel.client_remain_trafic(tun_id) or None
+
+    if vless_url:
+        last_good_configs.put(key, vless_url, trafic)
+    else:
+        # панель ответила, а клиента нет — старую строку больше не отдаём
+        last_good_configs.drop(key)
+    return vless_url, trafic
+
+
+def _retrieve(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+async def _fresh_or_stale(panel: ThreeXUIServer, tun_id: str, known_trafic: tuple | None = None):
+    """
+    Свежий конфиг панели, а если есть сохранённый и панель не ответила за SUBSCRIPTION_STALE_WAIT
+    или упала — сохранённый. Запрос к панели при этом не отменяется и обновит сохранённый конфиг.
+    Возвращает (vless, трафик, устаревший ли).
+    """
+    stale = last_good_configs.get((panel.id, tun_id))
+    task = asyncio.create_task(_panel_config(panel, tun_id, known_trafic))
+    task.add_done_callback(_retrieve)
+
+    await asyncio.wait({task}, timeout=SUBSCRIPTION_STALE_WAIT if stale else None)
+    if task.done() and task.exception() is None:
+        vless_url, trafic = task.result()
+        return vless_url, trafic, False
+    if stale is None:
+        raise task.exception()
+
+    vless_url, trafic, age = stale
+    label = urlsplit(panel.url).netloc
+    STALE_SERVED.inc(label)
+    STALE_AGE.observe(label, value=age)
+    logger.info(f"Панель {panel.id} не ответила, отдан сохранённый конфиг возрастом {age:.0f}с")
+    return vless_url, trafic, True
+
+
+def known_traffics(user_servers) -> dict[str, tuple[int, int, int]]:
+    """{tun_id: (up, down, total)} из traffic_snapshots, загруженных вместе с users_servers."""
+    return {
+        user_server.tun_id: (user_server.traffic.up, user_server.traffic.down, user_server.traffic.total)
+        for user_server in user_servers
+        if user_server.traffic is not None
+    }
+
+
+async def collect_configs(
+    pairs: list[tuple[ThreeXUIServer, str]],
+    deadline: float = SUBSCRIPTION_DEADLINE,
+    traffics: dict[str, tuple[int, int, int]] | None = None
+) -> tuple[list[str], tuple[int, int, int], bool]:
+    """
+    Опрашивает панели [(панель, tun_id)] конкурентно в пределах общего deadline.
+    Возвращает vless-строки в порядке pairs (свежие или сохранённые), трафик need_gb панели
+    и признак полноты: все строки свежие и ни одна панель не пропущена.
+    traffics — известный трафик по tun_id (см. known_traffics).
+    """
+    traffics = traffics or {}
+    results = await gather_with_deadline(
+        [_fresh_or_stale(panel, tun_id, traffics.get(tun_id)) for panel, tun_id in pairs],
+        timeout=deadline
+    )
+
+    config_lines = []
+    trafic = (0, 0, 0)
+    complete = True
+    for (panel, tun_id), (in_time, result) in zip(pairs, results):
+        if not in_time:
+            logger.warning(f"Панель {panel.id} не уложилась в {deadline}с, пропущена в подписке")
+            complete = False
+            continue
+
+        vless_url, panel_trafic, stale = result
+        if stale:
+            complete = False
+        if panel_trafic:
+            trafic = panel_trafic
+        if not vless_url:
+            logger.warning(f"Пользователь не найден на сервере {panel.id}")
+            continue
+        config_lines.append(vless_url)
+
+    return config_lines, trafic, complete
+
+
+class SubscriptionUnavailable(Exception):
+    """Подписку не собрать: нет серверов или ни одна панель не отдала конфиг."""
+
+
+def _b64(text: str) -> str:
+    return "base64:" + base64.b64encode(text.encode('utf-8')).decode('latin-1')
+
+
+def subscription_response(rendered: RenderedSubscription, if_none_match: str | None = None) -> Response:
+    """Ответ с ETag и Cache-Control; 304 без тела, если у клиента та же версия."""
+    max_age = SUBSCRIPTION_MAX_AGE
+    if rendered.valid_until:
+        # к окончанию подписки клиент должен прийти за новым ответом
+        max_age = max(0, min(max_age, int((rendered.valid_until - datetime.now()).total_seconds())))
+    cache_headers = {
+        'ETag': rendered.etag,
+        'Cache-Control': f"private, max-age={max_age}",
+    }
+
+    if rendered.matches(if_none_match):
+        return Response(status_code=304, headers=cache_headers)
+
+    return Response(
+        content=rendered.body,
+        media_type="text/plain; charset=utf-8",
+        headers={**rendered.headers, **cache_headers}
+    )
+
+
+async def render_subscription(session: AsyncSession, user, user_servers: dict) -> tuple[RenderedSubscription, bool]:
+    """
+    Тело и заголовки /api/subscribtion для пользователя.
+    user_servers — {server_id: UserServer} из orm_get_user_with_servers.
+    Возвращает (подписка, полная ли она — все панели ответили вовремя).
+    """
+    today = datetime.now()
+
+    if not user.sub_end or user.sub_end < today:
+        body = (
+            f"vless://{user.id}@1.23.123.4:8452?"
+            f"type=tcp&spx=%2F&flow=#{quote('❌ Ваша подписка закончилась')}"
+        )
+        headers = {
+            'profile-title': _b64('⚡️ SkynetVPN'),
+            'announce': _b64("🚀 Нажмите сюда, тут можно продлить подписку"),
+            'announce-url': "https://t.me/skynetaivpn_bot",
+        }
+        return RenderedSubscription(body, headers), True
+
+    if not user_servers:
+        raise SubscriptionUnavailable("No servers for user")
+
+    # Порядок — по серверам (отсортированы по id), а не по user_servers
+    pairs = [
+        (panel, user_servers[panel.id].tun_id)
+        for panel in await get_panels(session)
+        if panel.id in user_servers
+    ]
+
+    config_lines, trafic, complete = await collect_configs(pairs, traffics=known_traffics(user_servers.values()))
+
+    if not config_lines:
+        raise SubscriptionUnavailable("No configs found")
+
+    headers = {
+        'profile-title': _b64('⚡️ SkynetVPN'),
+        'announce': _b64(
+            "🚀 Нажмите сюда, чтобы перейти в нашего бота\n\n"
+            "👑 - без рекламы на YouTube\n"
+            "🎧 - YouTube можно сворачивать \n\n"
+            "Отображаемое количество трафика относиться только к обходу белых списков."
+        ),
+        'announce-url': "https://t.me/skynetaivpn_bot",
+        'subscription-userinfo': (
+            f"expire={int(user.sub_end.timestamp())}; "
+            f"upload={trafic[0]}; download={trafic[1]}; total={trafic[2]}"
+        ),
+        'X-Frame-Options': "SAMEORIGIN",
+        'Referrer-Policy': "no-referrer-when-downgrade",
+        'X-Content-Type-Options': "nosniff",
+        'Permissions-Policy': "geolocation=(), microphone=()",
+        'Strict-Transport-Security': "max-age=63072000; includeSubDomains; preload",
+    }
+    rendered = RenderedSubscription("\n".join(config_lines), headers, valid_until=user.sub_end)
+    return rendered, complete
+
+
+async def warm_subscription(session: AsyncSession, user_id) -> bool:
+    """Собирает подписку /api/subscribtion заранее (после оплаты), чтобы первый запрос попал в кэш."""
+    version = subscription_cache.version(user_id)
+    user, user_servers = await orm_get_user_with_servers(session, user_id=user_id)
+    if user is None:
+        return False
+    try:
+        rendered, complete = await render_subscription(session, user, user_servers)
+    except SubscriptionUnavailable as e:
+        logger.warning(f"Подписка {user.id} не прогрета: {e}")
+        return False
+    if not complete:
+        return False
+    return subscription_cache.put(('api', str(user.id)), user.id, rendered, version)
+
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import time
+from datetime import datetime
+
+
+class RenderedSubscription:
+    """Готовый ответ подписки: тело и заголовки."""
+
+    def __init__(self, body: str, headers: dict[str, str], valid_until: datetime | None = None) -> None:
+        self.body = body
+        self.headers = headers
+        # после окончания подписки ответ другой — дольше этого момента не кэшируем
+        self.valid_until = valid_until
+        self.created_at = time.monotonic()
+        # стабильный хэш содержимого: одинаковая подписка — одинаковый ETag между пересборками
+        digest = hashlib.sha256(body.encode('utf-8'))
+        for name in sorted(headers):
+            digest.update(f"\n{name}:{headers[name]}".encode('utf-8'))
+        self.etag = f'"{digest.hexdigest()[:32]}"'
+
+    def matches(self, if_none_match: str | None) -> bool:
+        """Совпадает ли If-None-Match с ETag (список через запятую, W/ и * допускаются)."""
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or any(tag.removeprefix('W/') == self.etag for tag in tags)
+
+
+class SubscriptionCache:
+    """
+    Отрендеренные подписки по ключу (эндпоинт, токен) с индексом по id пользователя для инвалидации.
+    Как и в InboundCache, инвалидация увеличивает версию пользователя, и сборка,
+    начатая до неё, не кладётся в кэш.
+    """
+
+    def __init__(self) -> None:
+        self.entries: dict[tuple[str, str], tuple[RenderedSubscription, float]] = {}
+        self.by_user: dict[object, set[tuple[str, str]]] = {}
+        self.versions: dict[object, int] = {}
+        self.generation = 0
+        self.ttl = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "300"))
+
+    def version(self, user_id) -> tuple[int, int]:
+        return self.generation, self.versions.get(user_id, 0)
+
+    def get(self, key: tuple[str, str]) -> RenderedSubscription | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        rendered, expires_at = entry
+        if time.monotonic() > expires_at:
+            self.entries.pop(key, None)
+            return None
+        return rendered
+
+    def put(self, key: tuple[str, str], user_id, rendered: RenderedSubscription, version: tuple[int, int]) -> bool:
+        if self.version(user_id) != version:
+            return False
+        ttl = self.ttl
+        if rendered.valid_until:
+            ttl = min(ttl, (rendered.valid_until - datetime.now()).total_seconds())
+        if ttl <= 0:
+            return False
+        self.entries[key] = (rendered, time.monotonic() + ttl)
+        self.by_user.setdefault(user_id, set()).add(key)
+        return True
+
+    def invalidate_user(self, user_id) -> None:
+        self.versions[user_id] = self.versions.get(user_id, 0) + 1
+        for key in self.by_user.pop(user_id, ()):
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Сброс всех подписок (изменился состав или параметры серверов)."""
+        self.generation += 1
+        self.entries.clear()
+        self.by_user.clear()
+
+
+subscription_cache = SubscriptionCache()
@@ -1,9 +1,41 @@
 import json
-from urllib.parse import quote
+import time
+from urllib.parse import urljoin, urlsplit
 
-from httpx import AsyncClient
+from httpx import AsyncClient, HTTPError, Response, TimeoutException
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.database.queries import orm_get_servers
 from app.setup_logger import logger
+from app.utils.circuit_breaker import CircuitOpenError, PanelBusyError, PanelUnavailableError
+from app.utils.edit_queue import edit_queues
+from app.utils import json_scan
+from app.utils.inbound_cache import InboundSnapshot, inbound_cache
+from app.utils.metrics import metrics
+from app.utils.panel_registry import panel_registry
+from app.utils.panel_sessions import PanelSession, panel_sessions
+from app.utils.vless_template import vless_templates
+
+
+PANEL_REQUESTS = metrics.counter(
+    'panel_requests_total', 'Запросы к API панелей 3x-ui по исходу', ('panel', 'op', 'outcome')
+)
+PANEL_LATENCY = metrics.histogram(
+    'panel_request_duration_seconds', 'Время запроса к API панели', ('panel', 'op')
+)
+PANEL_BYTES = metrics.counter(
+    'panel_response_bytes_total', 'Получено байт от API панели', ('panel', 'op')
+)
+
+
+def _op_name(path: str) -> str:
+    """Имя операции для метрик: login, get, addClient, updateClient, delClient, ..."""
+    if "/inbounds/" not in path:
+        return path.rstrip('/').split('/')[-1]
+    for part in path.split("/inbounds/")[1].split('/'):
+        if not part.isdigit():
+            return part
+    return "inbounds"
 
 
 class ThreeXUIServer:
@@ -14,7 +46,6 @@ class ThreeXUIServer:
         self.login = login
         self.password = password
         self.need_gb = need_gb
-        self.cookies = None
         self.name = name
 
     def strin_to_dict(self, string):
@@ -23,26 +54,116 @@ class ThreeXUIServer:
     def dict_to_sting(self, obj):
         return json.dumps(obj, indent=4, ensure_ascii=False)
 
+    @property
+    def host(self) -> str:
+        return self.url.split('/')[2].replace('https://', '').replace('http://', '').split(':')[0]
+
+    @property
+    def inbound_key(self) -> tuple[str, int]:
+        return (self.url, self.indoub_id)
+
+    @property
+    def client(self) -> AsyncClient:
+        """Долгоживущий клиент панели из процессного реестра."""
+        return panel_registry.get_client(self.url)
+
+    def _is_auth_failure(self, response: Response) -> bool:
+        """401 или редирект на страницу логина / корень панели (checkLogin 3x-ui) — сессия протухла."""
+        if response.status_code == 401:
+            return True
+        if response.is_redirect:
+            # Location обычно относительный: /secret/ при url панели https://host:2053/secret/
+            path = urlsplit(urljoin(self.url, response.headers.get('location', ''))).path.rstrip('/')
+            return 'login' in path or path == urlsplit(self.url).path.rstrip('/')
+        return False
+
+    async def _session(self, stale: PanelSession | None = None) -> PanelSession | None:
+        """
+        Сессия из общего кэша. Логинится, только если её нет или она совпадает со stale.
+        Одновременно по одной панели выполняется не больше одного /login.
+        """
+        session = panel_sessions.get(self.url, self.login)
+        if session and session is not stale:
+            return session
+
+        async with panel_sessions.lock(self.url, self.login):
+            session = panel_sessions.get(self.url, self.login)
+            if session and session is not stale:
+                return session
+            panel_sessions.invalidate(self.url, self.login, stale)
+            await self.auth()
+            return panel_sessions.get(self.url, self.login)
+
+    async def _request(self, method: str, path: str, **kwargs) -> Response | None:
+        """
+        Запрос к API панели с сессией из кэша и однократным перелогином на 401/редирект.
+        Возвращает None, если панель недоступна (таймаут, ошибка сети, разомкнутый предохранитель).
+        """
+        try:
+            session = await self._session()
+            response = await self._send(method, path, session, **kwargs)
+            if self._is_auth_failure(response):
+                logger.info(f"Сессия панели {self.url} истекла, повторный вход")
+                session = await self._session(stale=session)
+                response = await self._send(method, path, session, **kwargs)
+            return response
+        except PanelUnavailableError as e:
+            logger.warning(f"{e}: {path}")
+        except HTTPError as e:
+            logger.warning(f"Панель {self.url} не ответила на {path}: {e!r}")
+        return None
+
+    async def _send(self, method: str, path: str, session: PanelSession | None, **kwargs) -> Response:
+        """Отправка через предохранитель панели: 5xx и сетевые ошибки считаются отказами."""
+        headers = {'Cookie': session.cookie_header} if session else {}
+        panel, op = urlsplit(self.url).netloc, _op_name(path)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = await panel_registry.get_breaker(self.url).call(
+                lambda: self.client.request(method, self.url + path, headers=headers, **kwargs),
+                is_failure=lambda response: response.status_code >= 500
+            )
+            outcome = 'ok' if response.status_code < 300 else f'http_{response.status_code // 100}xx'
+            PANEL_BYTES.inc(panel, op, amount=response.num_bytes_downloaded)
+            return response
+        except CircuitOpenError:
+            outcome = 'circuit_open'
+            raise
+        except PanelBusyError:
+            outcome = 'busy'
+            raise
+        except TimeoutException:
+            outcome = 'timeout'
+            raise
+        except HTTPError:
+            outcome = 'network'
+            raise
+        finally:
+            PANEL_REQUESTS.inc(panel, op, outcome)
+            # отклонённые предохранителем запросы до панели не дошли — время не учитываем
+            if outcome not in ('circuit_open', 'busy'):
+                PANEL_LATENCY.observe(panel, op, value=time.perf_counter() - started)
+
     async def auth(self):
         data = {
             'username': self.login,
             'password': self.password,
             'twoFactorCode': ''
         }
-        async with AsyncClient() as client:
-            response = await client.post(url=self.url + 'login', json=data)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    pass
-                else:
-                    logger.warning(f"Не удалось авторизоваться: {self.url} - {data.get('msg')}")
-            else:
-                logger.warning(f"Не удалось авторизоваться: {self.url} - {response.status_code}")
-
-            self.cookies = response.cookies
+        response = await self._send('POST', 'login', None, json=data)
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('success'):
+                panel_sessions.set(self.url, self.login, response.cookies)
+                return True
+            logger.warning(f"Не удалось авторизоваться: {self.url} - {data.get('msg')}")
+        else:
+            logger.warning(f"Не удалось авторизоваться: {self.url} - {response.status_code}")
 
-    async def add_client(
+        return False
+
+    def make_client(
         self,
         uuid: str,
         email: str,
@@ -51,50 +172,89 @@ class ThreeXUIServer:
         tg_id: str,
         name: str,
         total_gb: int = 0
-    ):
-        if not self.cookies:
-            await self.auth()
-
+    ) -> dict:
+        """Объект клиента для settings.clients. total_gb в ГБ, в байты переводится только на need_gb панелях."""
         if self.need_gb:
             traffic_limit = (total_gb if total_gb else 30) * 1073741824
         else:
             traffic_limit = 0
 
+        return {
+            "id": uuid,
+            "alterId": 0,
+            "email": email,
+            "limitIp": limit_ip,
+            "expiryTime": expiry_time,
+            "enable": True,
+            "comment": name,
+            "tgId": str(tg_id),
+            "subId": uuid.split('-')[-1],
+            "totalGB": traffic_limit
+        }
+
+    async def add_client(
+        self,
+        uuid: str,
+        email: str,
+        limit_ip: int,
+        expiry_time: int,
+        tg_id: str,
+        name: str,
+        total_gb: int = 0
+    ):
+        client = self.make_client(uuid, email, limit_ip, expiry_time, tg_id, name, total_gb)
+        data = {
+            "id": self.indoub_id,
+            "settings": self.dict_to_sting({"clients": [client]})
+        }
+
+        response = await self._request(
+            'POST', "panel/api/inbounds/addClient",
+            json=data
+        )
+        if response is None:
+            return False
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('success'):
+                inbound_cache.upsert_client(self.inbound_key, client)
+                logger.info(f"Добавлен клиент {name}")
+                return True
+            logger.warning(f"Не удалось добавить клиента {name}: {data.get('msg')}")
+            return False
+
+        logger.warning(f"Не удалось добавить клиента {name}: {self.url} - {response.status_code}")
+        return False
+
+    async def add_clients(self, clients: list[dict]) -> bool:
+        """Добавляет пачку клиентов (из make_client) одним запросом addClient."""
+        if not clients:
+            return True
+
         data = {
             "id": self.indoub_id,
-            "settings": self.dict_to_sting({
-                "clients": [{
-                    "id": uuid,
-                    "alterId": 0,
-                    "email": email,
-                    "limitIp": limit_ip,
-                    "expiryTime": expiry_time,
-                    "enable": True,
-                    "comment": name,
-                    "tgId": str(tg_id),
-                    "subId": uuid.split('-')[-1],
-                    "totalGB": traffic_limit
-                }]
-            })
+            "settings": json.dumps({"clients": clients}, ensure_ascii=False)
         }
 
-        async with AsyncClient() as client:
-            response = await client.post(
-                url=self.url + "panel/api/inbounds/addClient",
-                json=data,
-                cookies=self.cookies
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    logger.info(f"Добавлен клиент {name}")
-                    return True
-                logger.warning(f"Не удалось добавить клиента {name}: {data.get('msg')}")
-                return False
-
-            logger.warning(f"Не удалось добавить клиента {name}: {self.url} - {response.status_code}")
+        response = await self._request(
+            'POST', "panel/api/inbounds/addClient",
+            json=data
+        )
+        if response is None:
+            return False
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('success'):
+                for client in clients:
+                    inbound_cache.upsert_client(self.inbound_key, client)
+                logger.info(f"Добавлено клиентов: {len(clients)} на {self.url}")
+                return True
+            logger.warning(f"Не удалось добавить {len(clients)} клиентов на {self.url}: {data.get('msg')}")
             return False
 
+        logger.warning(f"Не удалось добавить {len(clients)} клиентов: {self.url} - {response.status_code}")
+        return False
+
     async def edit_client(
         self,
         uuid: str,
@@ -105,190 +265,203 @@ class ThreeXUIServer:
         tg_id: str,
         total_gb: int = 0
     ):
-        if not self.cookies:
-            await self.auth()
-
-        # total_gb передаём в ГБ (как в add_client). Здесь приводим к байтам только для need_gb панелей.
-        if self.need_gb:
-            traffic_limit = (total_gb if total_gb else 30) * 1073741824
-        else:
-            traffic_limit = 0
-
+        # total_gb передаём в ГБ (как в add_client)
+        client = self.make_client(uuid, email, limit_ip, expiry_time, tg_id, name, total_gb)
+        # повторные правки того же клиента, ещё не ушедшие в панель, сливаются в один updateClient
+        queue = edit_queues.get(self.inbound_key, self.url)
+        return await queue.submit(client, self._update_client)
+
+    async def _update_client(self, client: dict) -> bool:
+        uuid, email = client['id'], client['email']
         data = {
             "id": self.indoub_id,
-            "settings": self.dict_to_sting({
-                "clients": [{
-                    "id": uuid,
-                    "alterId": 0,
-                    "email": email,
-                    "limitIp": limit_ip,
-                    "expiryTime": expiry_time,
-                    "enable": True,
-                    "tgId": str(tg_id),
-                    "subId": uuid.split('-')[-1],
-                    "comment": name,
-                    "totalGB": traffic_limit
-                }]
-            })
+            "settings": self.dict_to_sting({"clients": [client]})
         }
 
-        async with AsyncClient() as client:
-            response = await client.post(
-                url=self.url + f"panel/api/inbounds/updateClient/{uuid}",
-                json=data,
-                cookies=self.cookies
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    logger.info(f"Изменен клиент {email}")
-                    return True
-                logger.warning(f"Не удалось изменить клиента {email}: {data.get('msg')}")
-                return False
-
-            logger.warning(f"Не удалось изменить клиента {email}: {response.status_code}")
+        response = await self._request(
+            'POST', f"panel/api/inbounds/updateClient/{uuid}",
+            json=data
+        )
+        if response is None:
+            return False
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('success'):
+                inbound_cache.upsert_client(self.inbound_key, client)
+                logger.info(f"Изменен клиент {email}")
+                return True
+            logger.warning(f"Не удалось изменить клиента {email}: {data.get('msg')}")
             return False
 
+        logger.warning(f"Не удалось изменить клиента {email}: {response.status_code}")
+        return False
+
+    async def get_traffics(self, force: bool = False) -> dict[str, tuple[int, int, int]] | None:
+        """
+        Трафик всех клиентов inbound одним запросом (clientStats из inbounds/get):
+        {uuid: (up, down, total)} в байтах. force=True — без кэша.
+        """
+        snapshot = await self.get_inbound(force=force)
+        if snapshot is None:
+            return None
+        return snapshot.traffics
+
     async def client_remain_trafic(self, uuid: str):
-        if not self.cookies:
-            await self.auth()
+        snapshot = await self.get_inbound()
+        if snapshot is None:
+            logger.warning(f"Не удалось получить трафик клиента {uuid}: {self.url}")
+            return False
 
-        async with AsyncClient() as client:
-            response = await client.get(
-                url=f"{self.url}panel/api/inbounds/getClientTrafficsById/{uuid}",
-                cookies=self.cookies
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    # up/down/total — в байтах
-                    return (data['obj'][0]['up'], data['obj'][0]['down'], data['obj'][0]['total'])
-                logger.warning(f"Не удалось получить трафик клиента {uuid}: {data.get('msg')}")
-                return False
-
-            logger.warning(f"Не удалось получить трафик клиента {uuid}: {response.status_code}")
+        # up/down/total — в байтах
+        traf = snapshot.traffic(uuid)
+        if traf is None:
+            logger.warning(f"Не удалось получить трафик клиента {uuid}: клиент не найден")
             return False
+        return traf
 
     async def get_total_gb(self, uuid: str) -> int:
-        """Текущий лимит totalGB в ГБ (по данным getClientTrafficsById)."""
+        """Текущий лимит totalGB в ГБ (по данным clientStats)."""
         traf = await self.client_remain_trafic(uuid)
         if not traf:
             return 0
         total_bytes = traf[2] or 0
         return int(total_bytes // 1073741824)
 
+    async def _load_inbound(self) -> InboundSnapshot | None:
+        version = inbound_cache.version(self.inbound_key)
+        response = await self._request(
+            'GET', f"panel/api/inbounds/get/{self.indoub_id}"
+        )
+        if response is None:
+            return None
+
+        if response.status_code != 200:
+            logger.warning(f"Не удалось получить inbound {self.indoub_id}: {self.url} - {response.status_code}")
+            return None
+
+        data = response.json()
+        if not data.get("success"):
+            logger.warning(f"Не удалось получить inbound {self.indoub_id}: {data.get('msg')}")
+            return None
+
+        inbound = data.get("obj") or {}
+        # settings со всеми клиентами не разбираем: клиент находится сканированием,
+        # полный индекс строится только там, где нужен весь список (InboundSnapshot.build)
+        settings_raw = inbound.get('settings') or '{}'
+        stream_settings_raw = inbound.get('streamSettings') or '{}'
+        stream_settings = self.strin_to_dict(stream_settings_raw)
+        template_settings = {'encryption': json_scan.find_value(settings_raw, 'encryption', 'none')}
+        snapshot = InboundSnapshot(
+            inbound,
+            settings_raw=settings_raw,
+            stream_settings=stream_settings,
+            template=vless_templates.get(self.host, inbound.get('port'), template_settings, stream_settings_raw, stream_settings),
+        )
+        inbound_cache.put(self.inbound_key, snapshot, version)
+        return snapshot
+
+    async def get_inbound(self, force: bool = False) -> InboundSnapshot | None:
+        """
+        Снапшот inbound из кэша. Устаревший снапшот отдаётся сразу и обновляется в фоне,
+        force=True — всегда свежая загрузка.
+        """
+        snapshot = None if force else inbound_cache.get(self.inbound_key)
+        if snapshot is None:
+            return await inbound_cache.fetch(self.inbound_key, self._load_inbound)
+
+        if not inbound_cache.is_fresh(snapshot):
+            inbound_cache.refresh_in_background(self.inbound_key, self._load_inbound)
+        return snapshot
+
+    async def _find_client(self, uuid: str) -> tuple[InboundSnapshot | None, dict | None]:
+        snapshot = await self.get_inbound()
+        if snapshot is None:
+            return None, None
+
+        client_obj = snapshot.find_client(uuid)
+        if client_obj is None and snapshot.age > 1 and not inbound_cache.missed_recently(self.inbound_key, uuid):
+            # клиента могли добавить мимо этого процесса — перечитываем один раз,
+            # а подтверждённое отсутствие запоминаем на INBOUND_MISS_TTL
+            snapshot = await self.get_inbound(force=True)
+            client_obj = snapshot.find_client(uuid) if snapshot else None
+            if snapshot is not None and client_obj is None:
+                inbound_cache.mark_missing(self.inbound_key, uuid)
+        return snapshot, client_obj
+
     async def get_client_vless(self, uuid: str):
-        if not self.cookies:
-            await self.auth()
+        snapshot, client_obj = await self._find_client(uuid)
+        if snapshot is None:
+            logger.warning(f"Не удалось подключиться к индаубу: {self.url}")
+            return
 
-        async with AsyncClient() as client:
-            response = await client.get(
-                url=f"{self.url}panel/api/inbounds/get/{self.indoub_id}",
-                cookies=self.cookies
-            )
+        if not client_obj:
+            logger.warning("Клиент не найден")
+            return
 
-            if response.status_code != 200:
-                logger.warning(f"Не удалось подключиться к индаубу: {self.url} - {response.status_code}")
-                return
-
-            data = response.json()['obj']
-            settings = self.strin_to_dict(data['settings'])
-            stream_settings = self.strin_to_dict(data['streamSettings'])
-            ip = self.url.split('/')[2].replace('https://', '').replace('http://', '').split(':')[0]
-
-            client_obj = {}
-            for i in settings['clients']:
-                if i['id'] == uuid:
-                    client_obj = i
-                    break
-
-            if not client_obj:
-                logger.warning("Клиент не найден")
-                return
-
-            return (
-                f"vless://{uuid}@{ip}:{data['port']}?"
-                f"type={stream_settings['network']}&"
-                f"security={stream_settings.get('security', 'none')}&"
-                f"encryption={settings.get('encryption', 'none')}&"
-                f"path={stream_settings.get('xhttpSettings', {}).get('path', '') or stream_settings.get('wsSettings', {}).get('path', '')}&"
-                f"pbk={stream_settings.get('realitySettings', {}).get('settings', {}).get('publicKey', 'none')}&"
-                f"fp={stream_settings.get('realitySettings', {}).get('settings', {}).get('fingerprint', 'none')}&"
-                f"sni={stream_settings.get('realitySettings', {}).get('target', 'none').split(':')[0]}&"
-                f"sid={stream_settings.get('realitySettings', {}).get('shortIds', [''])[0]}&"
-                f"spx=%2F&flow={client_obj.get('flow', '')}#{quote(client_obj['email'].split('_')[0])}"
-            )
+        return snapshot.template.render_client(client_obj)
 
     async def delete_client(self, uuid: str):
-        if not self.cookies:
-            await self.auth()
-
-        async with AsyncClient() as client:
-            response = await client.post(
-                url=self.url + f"panel/api/inbounds/{self.indoub_id}/delClient/{uuid}",
-                cookies=self.cookies
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    logger.info(f"Удален клиент {uuid}")
-                    return True
-                logger.warning(f"Не удалось удалить клиента {uuid}: {data.get('msg')}")
-                return False
-
-            logger.warning(f"Не удалось удалить клиента {uuid}: {response.status_code}")
+        response = await self._request(
+            'POST', f"panel/api/inbounds/{self.indoub_id}/delClient/{uuid}"
+        )
+        if response is None:
             return False
-
-    async def reset_client_traffic(self, email: str):
-        """Сбросить трафик клиента по email"""
-        if not self.cookies:
-            await self.auth()
-
-        async with AsyncClient() as client:
-            response = await client.post(
-                url=f"{self.url}panel/api/inbounds/{self.indoub_id}/resetClientTraffic/{email}",
-                cookies=self.cookies
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    logger.info(f"Сброшен трафик клиента {email}")
-                    return True
-                logger.warning(f"Не удалось сбросить трафик {email}: {data.get('msg')}")
-                return False
-
-            logger.warning(f"Не удалось сбросить трафик {email}: {response.status_code}")
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('success'):
+                inbound_cache.remove_client(self.inbound_key, uuid)
+                logger.info(f"Удален клиент {uuid}")
+                return True
+            logger.warning(f"Не удалось удалить клиента {uuid}: {data.get('msg')}")
             return False
 
+        logger.warning(f"Не удалось удалить клиента {uuid}: {response.status_code}")
+        return False
 
-    async def get_client_by_uuid(self, uuid: str) -> dict | None:
-        """Достаёт объект клиента из inbound settings по uuid."""
-        if not self.cookies:
-            await self.auth()
-
-        async with AsyncClient() as client:
-            response = await client.get(
-                url=f"{self.url}panel/api/inbounds/get/{self.indoub_id}",
-                cookies=self.cookies
-            )
-
-            if response.status_code != 200:
-                logger.warning(f"Не удалось получить inbound {self.indoub_id}: {response.status_code}")
-                return None
-
+    async def reset_all_client_traffic(self):
+        """Сбросить трафик всех клиентов inbound одним запросом"""
+        response = await self._request(
+            'POST', f"panel/api/inbounds/resetAllClientTraffics/{self.indoub_id}"
+        )
+        if response is None:
+            return False
+        if response.status_code == 200:
             data = response.json()
-            if not data.get("success"):
-                logger.warning(f"Не удалось получить inbound {self.indoub_id}: {data.get('msg')}")
-                return None
-
-            inbound = data.get("obj") or {}
-            settings_raw = inbound.get("settings")
-            if not settings_raw:
-                return None
-
-            settings = self.strin_to_dict(settings_raw)
-            for c in settings.get("clients", []):
-                if c.get("id") == uuid:
-                    return c
+            if data.get('success'):
+                inbound_cache.invalidate(self.inbound_key)
+                logger.info(f"Сброшен трафик всех клиентов inbound {self.indoub_id}: {self.url}")
+                return True
+            logger.warning(f"Не удалось сбросить трафик inbound {self.indoub_id}: {data.get('msg')}")
+            return False
 
-        return None
+        logger.warning(f"Не удалось сбросить трафик inbound {self.indoub_id}: {response.status_code}")
+        return False
+
+
+async def get_panels(session: AsyncSession) -> list[ThreeXUIServer]:
+    """
+    Панели всех серверов (по возрастанию id) из процессного реестра.
+    БД читается только при первом обращении и после orm_add/update/delete_server.
+    """
+    panels = panel_registry.panels
+    if panels is None:
+        async with panel_registry.panels_lock:
+            panels = panel_registry.panels
+            if panels is None:
+                version = panel_registry.panels_version
+                servers = await orm_get_servers(session)
+                panels = {
+                    s.id: ThreeXUIServer(s.id, s.url, s.indoub_id, s.login, s.password, s.need_gb, s.name)
+                    for s in servers
+                }
+                # сервер могли изменить, пока шёл запрос, — тогда не кэшируем
+                if panel_registry.panels_version == version:
+                    panel_registry.panels = panels
+    return list(panels.values())
+
+
+async def get_panel(session: AsyncSession, server_id: int) -> ThreeXUIServer | None:
+    for panel in await get_panels(session):
+        if panel.id == server_id:
+            return panel
+    return None
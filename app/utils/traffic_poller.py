@@ -0,0 +1,68 @@
+import os
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.engine import async_session_maker
+from app.database.models import UserServer
+from app.database.queries import (
+    orm_get_db_now,
+    orm_get_traffic_snapshot,
+    orm_get_user_servers_by_si,
+    orm_set_traffic_total,
+    orm_upsert_traffic_snapshots
+)
+from app.setup_logger import logger
+from app.utils.three_x_ui_api import ThreeXUIServer, get_panels
+
+
+GB = 1073741824
+# как часто снимать трафик need_gb панелей, секунды
+TRAFFIC_POLL_INTERVAL = int(os.getenv("TRAFFIC_POLL_INTERVAL", "300"))
+
+
+async def poll_panel_traffic(session: AsyncSession, panel: ThreeXUIServer) -> int:
+    """Один inbounds/get на панель и upsert трафика всех её клиентов в traffic_snapshots."""
+    # снимки, обновлённые после начала запроса (remember_total_gb), свежее ответа панели
+    fetched_at = await orm_get_db_now(session)
+    traffics = await panel.get_traffics(force=True)
+    if traffics is None:
+        logger.warning(f"Не удалось снять трафик панели {panel.name}")
+        return 0
+
+    rows = []
+    for user_server in await orm_get_user_servers_by_si(session, panel.id):
+        traf = traffics.get(user_server.tun_id)
+        if traf:
+            up, down, total = traf
+            rows.append({'user_server_id': user_server.id, 'up': up, 'down': down, 'total': total})
+
+    await orm_upsert_traffic_snapshots(session, rows, fetched_at)
+    return len(rows)
+
+
+async def poll_traffic():
+    """Плановое обновление traffic_snapshots по всем need_gb панелям."""
+    async with async_session_maker() as session:
+        for panel in await get_panels(session):
+            if not panel.need_gb:
+                continue
+            try:
+                count = await poll_panel_traffic(session, panel)
+                logger.info(f"Трафик панели {panel.name} обновлён: {count} клиентов")
+            except Exception as e:
+                logger.error(f"Ошибка снятия трафика панели {panel.name}: {e}")
+
+
+async def known_total_bytes(session: AsyncSession, panel: ThreeXUIServer, user_server: UserServer) -> int | None:
+    """Текущий лимит totalGB в байтах: из traffic_snapshots, а если снимка ещё нет — с панели."""
+    snapshot = await orm_get_traffic_snapshot(session, user_server.id)
+    if snapshot is not None:
+        return snapshot.total
+    traf = await panel.client_remain_trafic(user_server.tun_id)
+    return traf[2] if traf else None
+
+
+async def remember_total_gb(session: AsyncSession, user_server: UserServer, total_gb: int):
+    """После успешного изменения лимита в панели — сразу в снимок, чтобы не ждать поллер."""
+    await orm_set_traffic_total(session, user_server.id, int(total_gb) * GB)
+
@@ -0,0 +1,51 @@
+from urllib.parse import quote
+
+
+class VlessTemplate:
+    """
+    Скомпилированная vless-ссылка inbound: всё, кроме uuid, flow и подписи клиента,
+    собирается один раз из streamSettings.
+    """
+
+    def __init__(self, host: str, port: int, settings: dict, stream_settings: dict) -> None:
+        reality = stream_settings.get('realitySettings', {})
+        path = stream_settings.get('xhttpSettings', {}).get('path', '') or stream_settings.get('wsSettings', {}).get('path', '')
+        self.tail = (
+            f"@{host}:{port}?"
+            f"type={stream_settings.get('network', 'tcp')}&"
+            f"security={stream_settings.get('security', 'none')}&"
+            f"encryption={settings.get('encryption', 'none')}&"
+            f"path={path}&"
+            f"pbk={reality.get('settings', {}).get('publicKey', 'none')}&"
+            f"fp={reality.get('settings', {}).get('fingerprint', 'none')}&"
+            f"sni={reality.get('target', 'none').split(':')[0]}&"
+            f"sid={reality.get('shortIds', [''])[0]}&"
+            f"spx=%2F&flow="
+        )
+
+    def render(self, uuid: str, flow: str, label: str) -> str:
+        return f"vless://{uuid}{self.tail}{flow}#{quote(label)}"
+
+    def render_client(self, client: dict) -> str:
+        """Ссылка для объекта клиента из settings.clients (подпись — имя сервера из email)."""
+        return self.render(client['id'], client.get('flow', ''), client['email'].split('_')[0])
+
+
+class VlessTemplateCache:
+    """Шаблоны по (host, port, streamSettings, encryption): пересобираются только при их изменении."""
+
+    def __init__(self) -> None:
+        self.templates: dict[tuple, VlessTemplate] = {}
+
+    def get(self, host: str, port: int, settings: dict, stream_settings_raw: str, stream_settings: dict) -> VlessTemplate:
+        key = (host, port, stream_settings_raw, settings.get('encryption'))
+        template = self.templates.get(key)
+        if template is None:
+            # старые версии того же inbound больше не нужны
+            for old_key in [k for k in self.templates if k[:2] == (host, port)]:
+                self.templates.pop(old_key)
+            template = self.templates[key] = VlessTemplate(host, port, settings, stream_settings)
+        return template
+
+
+vless_templates = VlessTemplateCache()
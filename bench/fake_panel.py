@@ -0,0 +1,217 @@
+"""
+Фейковая 3x-ui панель для тестов и нагрузочных замеров.
+
+Реализует login, inbounds/get, addClient, updateClient, delClient
+и resetAllClientTraffics с настраиваемой задержкой,
+долей ошибок и количеством клиентов. Работает in-process через
+await FakePanel.mount(url) (httpx.ASGITransport) или на localhost:
+
+    python -m bench.fake_panel --port 2053 --clients 10000 --latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import secrets
+from collections import Counter
+from uuid import uuid4
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, RedirectResponse
+from httpx import ASGITransport, AsyncClient
+
+from app.utils.panel_registry import panel_registry
+from app.utils.three_x_ui_api import _op_name
+
+
+GB = 1073741824
+
+STREAM_SETTINGS = {
+    "network": "tcp",
+    "security": "reality",
+    "realitySettings": {
+        "target": "www.example.com:443",
+        "shortIds": ["6ba85179e30d4fc2"],
+        "settings": {"publicKey": "fake-public-key", "fingerprint": "chrome"},
+    },
+}
+
+
+class FakePanel:
+    def __init__(
+        self,
+        inbound_id: int = 1,
+        port: int = 443,
+        clients: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        login: str = "admin",
+        password: str = "admin",
+        seed: int | None = None,
+        auth_redirect: int | None = None,
+    ) -> None:
+        self.inbound_id = inbound_id
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.login = login
+        self.password = password
+        self.random = random.Random(seed)
+        # код редиректа на корень панели вместо 401 без сессии (как checkLogin в 3x-ui)
+        self.auth_redirect = auth_redirect
+
+        self.sessions: set[str] = set()
+        self.clients: dict[str, dict] = {}
+        self.traffics: dict[str, dict] = {}
+        self.calls: Counter = Counter()
+
+        for i in range(clients):
+            self.put_client({
+                "id": str(uuid4()),
+                "email": f"seed_{i}",
+                "limitIp": 2,
+                "expiryTime": 0,
+                "enable": True,
+                "totalGB": 30 * GB,
+            })
+
+        self.app = self._build_app()
+
+    # --- состояние ---
+
+    def put_client(self, client: dict, up: int = 0, down: int = 0) -> None:
+        client.setdefault("flow", "xtls-rprx-vision")
+        self.clients[client["id"]] = client
+        self.traffics[client["email"]] = {
+            "email": client["email"],
+            "up": up,
+            "down": down,
+            "total": client.get("totalGB") or 0,
+            "enable": True,
+        }
+
+    def inbound(self) -> dict:
+        return {
+            "id": self.inbound_id,
+            "port": self.port,
+            "protocol": "vless",
+            "settings": json.dumps({"clients": list(self.clients.values()), "decryption": "none"}),
+            "streamSettings": json.dumps(STREAM_SETTINGS),
+            "clientStats": list(self.traffics.values()),
+        }
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    async def mount(self, url: str) -> None:
+        """Подменяет пуловый клиент панели url на in-process транспорт к этой панели (старый закрывается)."""
+        old = panel_registry.clients.get(url)
+        if old is not None:
+            await old.aclose()
+        panel_registry.clients[url] = AsyncClient(transport=ASGITransport(app=self.app))
+
+    # --- http ---
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+        panel = self
+
+        @app.middleware("http")
+        async def simulate(request: Request, call_next):
+            panel.calls[_op_name(request.url.path)] += 1
+            if panel.latency or panel.jitter:
+                await asyncio.sleep(panel.latency + panel.random.uniform(0, panel.jitter))
+            if panel.error_rate and panel.random.random() < panel.error_rate:
+                return JSONResponse({"success": False, "msg": "simulated error"}, status_code=500)
+            if request.url.path.startswith("/panel/") and request.cookies.get("3x-ui") not in panel.sessions:
+                if panel.auth_redirect:
+                    return RedirectResponse("/", status_code=panel.auth_redirect)
+                return JSONResponse({"success": False, "msg": "unauthorized"}, status_code=401)
+            return await call_next(request)
+
+        @app.post("/login")
+        async def login(request: Request):
+            data = await request.json()
+            if data.get("username") != panel.login or data.get("password") != panel.password:
+                return {"success": False, "msg": "wrong username or password"}
+            token = secrets.token_hex(8)
+            panel.sessions.add(token)
+            response = JSONResponse({"success": True, "msg": "Login successfully"})
+            response.set_cookie("3x-ui", token, max_age=3600, path="/")
+            return response
+
+        @app.get("/panel/api/inbounds/get/{inbound_id}")
+        async def get_inbound(inbound_id: int):
+            if inbound_id != panel.inbound_id:
+                return {"success": False, "msg": "inbound not found"}
+            return {"success": True, "obj": panel.inbound()}
+
+        @app.post("/panel/api/inbounds/addClient")
+        async def add_client(request: Request):
+            data = await request.json()
+            clients = json.loads(data["settings"])["clients"]
+            emails = {c["email"] for c in panel.clients.values()}
+            for client in clients:
+                if client["id"] in panel.clients or client["email"] in emails:
+                    return {"success": False, "msg": f"Duplicate email: {client['email']}"}
+            for client in clients:
+                panel.put_client(client)
+            return {"success": True, "msg": "Client(s) added"}
+
+        @app.post("/panel/api/inbounds/updateClient/{uuid}")
+        async def update_client(uuid: str, request: Request):
+            old = panel.clients.get(uuid)
+            if old is None:
+                return {"success": False, "msg": "client not found"}
+            client = json.loads((await request.json())["settings"])["clients"][0]
+            stats = panel.traffics.pop(old["email"], {})
+            panel.put_client(client, up=stats.get("up", 0), down=stats.get("down", 0))
+            return {"success": True, "msg": "Client updated"}
+
+        @app.post("/panel/api/inbounds/{inbound_id}/delClient/{uuid}")
+        async def del_client(inbound_id: int, uuid: str):
+            client = panel.clients.pop(uuid, None)
+            if client is None:
+                return {"success": False, "msg": "client not found"}
+            panel.traffics.pop(client["email"], None)
+            return {"success": True, "msg": "Client deleted"}
+
+        @app.post("/panel/api/inbounds/resetAllClientTraffics/{inbound_id}")
+        async def reset_all_client_traffics(inbound_id: int):
+            for stats in panel.traffics.values():
+                stats["up"] = stats["down"] = 0
+            return {"success": True, "msg": "All traffic reset"}
+
+        return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Фейковая 3x-ui панель")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--inbound-id", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--auth-redirect", type=int, default=None, help="редирект (302/307) вместо 401 без сессии")
+    args = parser.parse_args()
+
+    panel = FakePanel(
+        inbound_id=args.inbound_id,
+        clients=args.clients,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        auth_redirect=args.auth_redirect,
+    )
+    uvicorn.run(panel.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
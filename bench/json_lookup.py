@@ -0,0 +1,138 @@
+"""
+Поиск клиента в settings inbound: полный json.loads (прежний путь), полный разбор orjson
+и потоковый поиск app.utils.json_scan.find_client. Вторая таблица — самая долгая задержка
+event loop за время работы: разбор держит GIL, поэтому asyncio.to_thread её не убирает.
+
+    python -m bench.json_lookup --sizes 10000 50000 100000 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from uuid import uuid4
+
+from app.utils import json_scan
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_settings(clients: int) -> tuple[str, list[str]]:
+    uuids = [str(uuid4()) for _ in range(clients)]
+    settings = {
+        "clients": [
+            {
+                "id": uuid,
+                "alterId": 0,
+                "email": f"srv_{i}",
+                "limitIp": 2,
+                "expiryTime": 1767225600000,
+                "enable": True,
+                "comment": f"user{i}",
+                "tgId": str(10_000 + i),
+                "subId": uuid.split('-')[-1],
+                "totalGB": 0,
+                "flow": "xtls-rprx-vision",
+            }
+            for i, uuid in enumerate(uuids)
+        ],
+        "decryption": "none",
+        "encryption": "none",
+    }
+    return json.dumps(settings, indent=2), uuids
+
+
+def full_parse(loads):
+    def lookup(raw: str, uuid: str):
+        clients = loads(raw)["clients"]
+        return next((c for c in clients if c["id"] == uuid), None)
+    return lookup
+
+
+def measure(lookup, raw: str, targets: list[str], repeat: int) -> float:
+    """Среднее время одного поиска, мс."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for uuid in targets:
+            assert lookup(raw, uuid)["id"] == uuid
+    return (time.perf_counter() - started) * 1000 / (repeat * len(targets))
+
+
+async def _stall(work) -> float:
+    """Наибольшая задержка тика event loop (мс), пока выполняется корутина work()."""
+    worst = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal worst
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            worst = max(worst, time.perf_counter() - started - 0.001)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    await work()
+    done = True
+    await task
+    return worst * 1000
+
+
+def stall_methods(raw: str, target: str) -> dict:
+    loads = orjson.loads if orjson is not None else json.loads
+
+    async def inline_parse():
+        loads(raw)
+
+    async def thread_parse():
+        await asyncio.to_thread(loads, raw)
+
+    async def scan():
+        json_scan.find_client(raw, target)
+
+    return {"разбор": inline_parse, "to_thread": thread_parse, "json_scan": scan}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение способов поиска клиента в settings inbound")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 50_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    methods = {"json.loads": full_parse(json.loads)}
+    if orjson is not None:
+        methods["orjson.loads"] = full_parse(orjson.loads)
+    methods["json_scan"] = json_scan.find_client
+
+    rnd = random.Random(args.seed)
+    header = f"{'clients':>9}{'MB':>7}" + "".join(f"{name:>15}" for name in methods)
+    print(header + "   (мс на поиск: первый, средний, последний и 7 случайных клиентов)")
+    print("-" * len(header))
+    for size in args.sizes:
+        raw, uuids = make_settings(size)
+        targets = [uuids[0], uuids[size // 2], uuids[-1]] + rnd.sample(uuids, 7)
+        row = f"{size:>9}{len(raw) / 1e6:>7.1f}"
+        for lookup in methods.values():
+            row += f"{measure(lookup, raw, targets, args.repeat):>15.2f}"
+        print(row)
+
+    print()
+    header = f"{'clients':>9}" + "".join(f"{name:>15}" for name in stall_methods('{}', ''))
+    print(header + f"   (мс простоя event loop, разбор — {'orjson' if orjson is not None else 'json'})")
+    print("-" * len(header))
+    for size in args.sizes:
+        raw, uuids = make_settings(size)
+        row = f"{size:>9}"
+        for work in stall_methods(raw, uuids[-1]).values():
+            row += f"{max(asyncio.run(_stall(work)) for _ in range(args.repeat)):>15.1f}"
+        print(row)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+"""
+Нагрузочный замер /api/subscribtion, /subscription и /payment/get_payment против фейковых панелей.
+
+Приложение запускается in-process (httpx.ASGITransport, без lifespan и Telegram),
+БД — временный sqlite, панели — bench.fake_panel.FakePanel. Кроме rps и задержек
+считаются SQL-запросы (события SQLAlchemy) и вызовы панелей на запрос.
+
+    python -m bench.run_bench --users 200 --servers 4 --requests 2000 --concurrency 50 --latency 0.02
+
+Сравнение с сохранённым замером (параметры нагрузки берутся из него), код выхода 1 при регрессии:
+
+    python -m bench.run_bench --baseline bench/baseline.json
+    python -m bench.run_bench --write-baseline bench/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+_db_dir = tempfile.mkdtemp(prefix="skynet-bench-")
+os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{_db_dir}/bench.db")
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+from httpx import ASGITransport, AsyncClient  # noqa: E402
+from sqlalchemy import event, func, select  # noqa: E402
+
+from app.app import app  # noqa: E402
+from app.database.engine import async_session_maker, create_db, engine  # noqa: E402
+from app.database.models import PanelOperation, Payment, Server, Tariff, User, UserServer  # noqa: E402
+from app.tg_bot_router.bot import bot  # noqa: E402
+from app.utils.outbox import outbox  # noqa: E402
+from app.utils.subscription_cache import subscription_cache  # noqa: E402
+from app.utils.traffic_poller import poll_traffic  # noqa: E402
+from bench.fake_panel import GB, FakePanel  # noqa: E402
+
+
+async def _no_telegram(*args, **kwargs):
+    return None
+
+
+class BenchWorld:
+    """Засеянная БД + фейковые панели."""
+
+    def __init__(self, panels: list[FakePanel], users: list[User], payment_ids: list[int]) -> None:
+        self.panels = panels
+        self.users = users
+        self.payment_ids = payment_ids
+        self.db_queries = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._count_query)
+
+    def _count_query(self, *args) -> None:
+        self.db_queries += 1
+
+    @property
+    def panel_calls(self) -> int:
+        return sum(panel.total_calls for panel in self.panels)
+
+
+async def seed(users: int, servers: int, payments: int, latency: float, jitter: float, error_rate: float) -> BenchWorld:
+    await create_db()
+    panels = []
+    async with async_session_maker() as session:
+        tariff = Tariff(days=30, ips=2, trafic=30, price=299)
+        session.add(tariff)
+
+        server_rows = []
+        for i in range(servers):
+            panel = FakePanel(latency=latency, jitter=jitter, error_rate=error_rate, seed=i)
+            url = f"http://panel-{i}.bench/"
+            await panel.mount(url)
+            panels.append(panel)
+            server_rows.append(Server(
+                name=f"srv{i}", url=url, indoub_id=panel.inbound_id,
+                login=panel.login, password=panel.password, need_gb=(i == 0)
+            ))
+        session.add_all(server_rows)
+        await session.flush()
+
+        user_rows = [
+            User(
+                name=f"user{i}", telegram_id=10_000 + i, tariff_id=tariff.id,
+                sub_end=datetime.now() + timedelta(days=30), ips=2
+            )
+            for i in range(users)
+        ]
+        session.add_all(user_rows)
+        await session.flush()
+
+        user_servers = []
+        for user in user_rows:
+            for server in server_rows:
+                user_servers.append(UserServer(tun_id=str(uuid4()), user_id=user.id, server_id=server.id))
+        session.add_all(user_servers)
+        await session.flush()
+
+        panels_by_server = {server.id: panel for server, panel in zip(server_rows, panels)}
+        servers_by_id = {server.id: server for server in server_rows}
+        for us in user_servers:
+            panels_by_server[us.server_id].put_client({
+                "id": us.tun_id,
+                "email": f"{servers_by_id[us.server_id].name}_{us.id}",
+                "limitIp": 2,
+                "expiryTime": 0,
+                "enable": True,
+                "totalGB": 30 * GB,
+            }, up=GB, down=2 * GB)
+
+        payment_rows = [
+            Payment(user_id=user_rows[i % users].id, tariff_id=tariff.id)
+            for i in range(payments)
+        ]
+        session.add_all(payment_rows)
+        await session.commit()
+
+        return BenchWorld(panels, user_rows, [p.id for p in payment_rows])
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def drive(name: str, world: BenchWorld, make_request, total: int, concurrency: int, settle=None) -> dict:
+    """settle — корутина-функция, которую ждут после запросов: фоновая работа входит в rps и счётчики."""
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+    calls_before = world.panel_calls
+    queries_before = world.db_queries
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://bench") as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                started = time.perf_counter()
+                response = await make_request(client, i)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code >= 400:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        if settle is not None:
+            await settle()
+        elapsed = time.perf_counter() - started
+
+    panel_calls = world.panel_calls - calls_before
+    return _result(name, total, concurrency, elapsed, latencies, errors, panel_calls, world.db_queries - queries_before)
+
+
+async def drain(world: BenchWorld) -> dict:
+    """Разбирает outbox (панели и уведомления после оплат) так же, как фоновые воркеры."""
+    calls_before = world.panel_calls
+    queries_before = world.db_queries
+    latencies = []
+    started = time.perf_counter()
+    # операции, запущенные колбэками сразу (Outbox.dispatch), доработают сами
+    await asyncio.gather(*outbox.dispatching)
+
+    async def worker():
+        while True:
+            op_started = time.perf_counter()
+            if not await outbox.run_once():
+                return
+            latencies.append(time.perf_counter() - op_started)
+
+    while True:
+        await asyncio.gather(*(worker() for _ in range(outbox.workers)))
+        async with async_session_maker() as session:
+            pending = await session.scalar(
+                select(func.count()).select_from(PanelOperation).where(PanelOperation.status == 'pending')
+            )
+        if not pending:
+            break
+        # уведомления ждут соседние операции или backoff — подождём следующего окна
+        await asyncio.sleep(outbox.defer_delay)
+    elapsed = time.perf_counter() - started
+    return _result(
+        "outbox", len(latencies), outbox.workers, elapsed, latencies, 0,
+        world.panel_calls - calls_before, world.db_queries - queries_before
+    )
+
+
+def _result(name, total, concurrency, elapsed, latencies, errors, panel_calls, db_queries) -> dict:
+    return {
+        "scenario": name,
+        "requests": total,
+        "concurrency": concurrency,
+        "rps": total / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "errors": errors,
+        "panel_calls": panel_calls,
+        "panel_calls_per_request": panel_calls / total if total else 0.0,
+        "db_queries": db_queries,
+        "db_queries_per_request": db_queries / total if total else 0.0,
+    }
+
+
+def print_report(results: list[dict]) -> None:
+    header = (
+        f"{'scenario':<18}{'reqs':>7}{'conc':>6}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}"
+        f"{'panel calls':>13}{'calls/req':>11}{'sql/req':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['scenario']:<18}{r['requests']:>7}{r['concurrency']:>6}{r['rps']:>10.1f}"
+            f"{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['errors']:>8}{r['panel_calls']:>13}"
+            f"{r['panel_calls_per_request']:>11.2f}{r['db_queries_per_request']:>9.2f}"
+        )
+
+
+def compare(results: list[dict], baseline: dict, count_tolerance: float, time_tolerance: float | None) -> list[str]:
+    """
+    Регрессии относительно baseline: SQL-запросы и вызовы панелей на запрос, ошибки,
+    а если time_tolerance задан — rps и p99 (время зависит от машины, поэтому допуск шире).
+    """
+    expected = {r["scenario"]: r for r in baseline["results"]}
+    problems = []
+    for r in results:
+        base = expected.get(r["scenario"])
+        if base is None:
+            continue
+        name = r["scenario"]
+        for key in ("db_queries_per_request", "panel_calls_per_request"):
+            if r[key] > base[key] * (1 + count_tolerance) + 1e-9:
+                problems.append(f"{name}: {key} {r[key]:.2f} > {base[key]:.2f}")
+        if r["errors"] > base["errors"]:
+            problems.append(f"{name}: errors {r['errors']} > {base['errors']}")
+        if time_tolerance is None:
+            continue
+        if r["rps"] < base["rps"] * (1 - time_tolerance):
+            problems.append(f"{name}: rps {r['rps']:.1f} < {base['rps']:.1f}")
+        if r["p99_ms"] > base["p99_ms"] * (1 + time_tolerance):
+            problems.append(f"{name}: p99 {r['p99_ms']:.2f}ms > {base['p99_ms']:.2f}ms")
+    return problems
+
+
+async def run(args) -> list[dict]:
+    bot.send_message = _no_telegram
+    world = await seed(
+        users=args.users, servers=args.servers, payments=args.payments,
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate
+    )
+    # как при старте приложения: первый снимок трафика до запросов
+    await poll_traffic()
+
+    async def subscription(client, i):
+        user = world.users[i % len(world.users)]
+        return await client.get("/api/subscribtion", params={"user_token": str(user.id)})
+
+    async def subscription_cold(client, i):
+        # промах кэша подписок на каждый запрос: БД и панели (через inbound_cache)
+        user = world.users[i % len(world.users)]
+        subscription_cache.invalidate_user(user.id)
+        return await client.get("/api/subscribtion", params={"user_token": str(user.id)})
+
+    async def subscription_tg(client, i):
+        user = world.users[i % len(world.users)]
+        return await client.get("/subscription", params={"user_token": str(user.telegram_id)})
+
+    async def payment(client, i):
+        return await client.post("/payment/get_payment", data={
+            "OutSum": "299", "InvId": str(world.payment_ids[i]), "SignatureValue": "bench"
+        })
+
+    async def fulfilment(client, i):
+        # по одному: от колбэка до выполнения всех операций оплаты (ключи в панелях, уведомление)
+        response = await payment(client, half + i)
+        await dispatched()
+        return response
+
+    async def dispatched():
+        await asyncio.gather(*outbox.dispatching)
+
+    half = args.payments // 2
+
+    results = [
+        await drive("subscription", world, subscription, args.requests, args.concurrency),
+        await drive("subscription_cold", world, subscription_cold, args.requests, args.concurrency),
+        await drive("subscription_tg", world, subscription_tg, args.requests, args.concurrency),
+    ]
+    if args.payments:
+        concurrency = min(args.concurrency, half)
+        results.append(await drive("payment", world, payment, half, concurrency, settle=dispatched))
+        # повторные колбэки тех же InvId: OK без записи в БД и вызовов панелей
+        results.append(await drive("payment_retry", world, payment, half, concurrency))
+        results.append(await drive("fulfilment", world, fulfilment, args.payments - half, 1))
+        results.append(await drain(world))
+    return results
+
+
+PARAMS = ("users", "servers", "requests", "payments", "concurrency", "latency", "jitter", "error_rate")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный замер подписки и оплаты против фейковых панелей")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--servers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--payments", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка панели, секунды")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--baseline", help="JSON прошлого замера: сравнить и вернуть 1 при регрессии")
+    parser.add_argument("--write-baseline", help="сохранить замер в JSON как новый baseline")
+    parser.add_argument("--count-tolerance", type=float, default=0.1, help="допуск роста SQL/вызовов панелей на запрос")
+    parser.add_argument("--time-tolerance", type=float, default=0.5, help="допуск падения rps и роста p99")
+    parser.add_argument("--no-time", action="store_true", help="не сравнивать rps и p99 (другая машина)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        # нагрузка — как в baseline, иначе сравнивать нечего
+        for name in PARAMS:
+            setattr(args, name, baseline["params"][name])
+
+    results = asyncio.run(run(args))
+    print_report(results)
+
+    if args.write_baseline:
+        with open(args.write_baseline, "w", encoding="utf-8") as f:
+            json.dump({"params": {name: getattr(args, name) for name in PARAMS}, "results": results}, f, indent=2)
+            f.write("\n")
+
+    if baseline is not None:
+        problems = compare(results, baseline, args.count_tolerance, None if args.no_time else args.time_tolerance)
+        if problems:
+            print("\nРегрессия относительно " + args.baseline + ":")
+            for problem in problems:
+                print("  " + problem)
+            return 1
+        print("\nРегрессий относительно " + args.baseline + " нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())